@@ -47,15 +47,21 @@ python main.py --corpus healthy-comments --test all
 """
 
 import argparse  # Command line parsing
-import configparser  # Saving the models parameters
+import concurrent.futures  # Background checkpoint writing
+import csv  # Healthy-comments test set (when pandas is not installed)
 import datetime  # Chronometer
 import os  # Files management
+import shutil  # Model directory reset
+import threading  # Training input pipeline
 from tqdm import tqdm  # Progress bar
+import numpy as np
 import tensorflow as tf
-import csv
-import nltk
-import math
+try:
+    import pandas as pd  # Faster loading of the healthy-comments test set
+except ImportError:
+    pd = None
 import operator
+import heapq
 import json
 
 from chatbot.textdata import TextData
@@ -80,30 +86,62 @@ class Chatbot:
         """
         # Model/dataset parameters
         self.args = None
+        self.deviceCache = None  # (deviceName,) once getDevice() has parsed the arguments
 
         # Task specific object
         self.textData = None  # Dataset
         self.model = None  # Sequence to sequence model
 
+        # Bigram language model used for the MMI reranking
+        self.bigramKeys = None  # Sorted (prevId, currId) pairs encoded as prevId*(vocabSize+1)+currId
+        self.bigramLogProbs = None  # log P(curr|prev) associated with each key
+        self.bigramStartId = None  # Extra id representing <start> (not part of the vocabulary)
+
         # Tensorflow utilities for convenience saving/logging
         self.writer = None
         self.saver = None
         self.modelDir = ''  # Where the model is saved
         self.globStep = 0  # Represent the number of iteration for the current model
+        self.modelNameCache = (None, None)  # ((modelDir, step), modelName) of the last _getModelName() call
+        self.modelDirClean = False  # The clean marker is present in the model directory
+        self.modelParamsSaved = False  # The configuration has been written during this run
 
         # TensorFlow main session (we keep track for the daemon)
         self.sess = None
 
+        self.feederError = None  # Exception raised on the thread feeding the training batches
+
+        # Checkpoints written on background from a cpu copy of the variables, while the training continues
+        self.checkpointPool = None
+        self.checkpointFuture = None  # Save in progress
+        self.checkpointSess = None
+        self.checkpointVariables = None  # Variables of the model
+        self.checkpointInputs = None  # (initializer, placeholder) of each variable copy
+        self.checkpointSaver = None
+
+        # Frozen testing graph (weights as constants) used by the interactive and daemon modes
+        self.inferenceSess = None
+        self.inferenceInputs = None  # Maps the model placeholders to the frozen graph inputs
+        self.inferenceOutputs = None
+
         # Filename and directories constants
         self.MODEL_DIR_BASE = 'save/model'
         self.MODEL_NAME_BASE = 'model'
         self.MODEL_EXT = '.ckpt'
-        self.CONFIG_FILENAME = 'params.ini'
+        self.MODEL_INDEX_EXT = '.index'  # Checkpoints V2 are split in multiple files, the index identify the model
+        self.CONFIG_FILENAME = 'params.json'
+        self.CONFIG_LEGACY_FILENAME = 'params.ini'  # Configuration of the models saved before the json format
+        self.STEP_LOG_FILENAME = 'step.log'  # globStep of each checkpoint (the configuration is only written once per run)
+        self.CLEAN_MARKER_FILENAME = '.clean'  # Present while a reset model directory has no model saved
         self.CONFIG_VERSION = '0.3'
         self.TEST_IN_NAME = 'data/test/samples.txt'
         self.TEST_OUT_SUFFIX = '_predictions.txt'
         self.REFERENCES_SUFFIX = '_reference.txt'
-        self.SENTENCES_PREFIX = ['Q: ', 'A: ']
+        self.OUTPUT_BUFFER_SIZE = 1 << 20  # Buffer of the prediction/reference files (1MB)
+        self.SENTENCES_PREFIX = ('Q: ', 'A: ')
+        self.sentencesPrefix = self.SENTENCES_PREFIX  # Prefixes actually displayed (reversed in watson mode)
+        self.TEST_BATCH_SIZE = 32  # Number of sentences predicted at once when testing (without beam search)
+        self.NB_RERANKED_REPLIES = 10  # Number of MMI reranked candidates shown in interactive mode
 
     @staticmethod
     def parseArgs(args):
@@ -128,11 +166,13 @@ class Chatbot:
         globalArgs.add_argument('--playDataset', type=int, nargs='?', const=10, default=None,  help='if set, the program  will randomly play some samples(can be use conjointly with createDataset if this is the only action you want to perform)')
         globalArgs.add_argument('--reset', action='store_true', help='use this if you want to ignore the previous model present on the model directory (Warning: the model will be destroyed with all the folder content)')
         globalArgs.add_argument('--verbose', action='store_true', help='When testing, will plot the outputs at the same time they are computed')
-        globalArgs.add_argument('--keepAll', action='store_true', help='If this option is set, all saved model will be keep (Warning: make sure you have enough free disk space or increase saveEvery)')  # TODO: Add an option to delimit the max size
+        globalArgs.add_argument('--keepAll', action='store_true', help='If this option is set, the saved models will be keep, up to maxCheckpoints (Warning: make sure you have enough free disk space or increase saveEvery)')
+        globalArgs.add_argument('--maxCheckpoints', type=int, default=5, help='maximum number of recent models kept when keepAll is set (0 to keep all of them)')
         globalArgs.add_argument('--modelTag', type=str, default=None, help='tag to differentiate which model to store/load')
         globalArgs.add_argument('--rootDir', type=str, default=None, help='folder where to look for the models and data')
         globalArgs.add_argument('--watsonMode', action='store_true', help='Inverse the questions and answer when training (the network try to guess the question)')
         globalArgs.add_argument('--device', type=str, default=None, help='\'gpu\' or \'cpu\' (Warning: make sure you have enough free RAM), allow to choose on which hardware run the model')
+        globalArgs.add_argument('--inferenceDevice', type=str, choices=['cpu', 'gpu'], default=None, help='hardware on which run the model when testing (replace --device, cpu if none of them is given). The small beam search steps are usually faster on cpu')
         globalArgs.add_argument('--seed', type=int, default=None, help='random seed for replication')
 
         # Dataset options
@@ -171,6 +211,7 @@ class Chatbot:
         trainingArgs = parser.add_argument_group('Training options')
         trainingArgs.add_argument('--numEpochs', type=int, default=30, help='maximum number of epochs to run')
         trainingArgs.add_argument('--saveEvery', type=int, default=1000, help='nb of mini-batch step before creating a model checkpoint')
+        trainingArgs.add_argument('--summaryEvery', type=int, default=None, help='nb of mini-batch step between two summaries written for tensorboard (default: saveEvery/10)')
         trainingArgs.add_argument('--batchSize', type=int, default=10, help='mini-batch size')
         trainingArgs.add_argument('--learningRate', type=float, default=0.001, help='Learning rate')
 
@@ -191,16 +232,16 @@ class Chatbot:
             self.args.maxLength = 100
             if self.args.encode_food_descrips:
                 self.MODEL_DIR_BASE = 'save/food-meal-model'
-                self.SENTENCES_PREFIX = ['Input food: ', 'Output meal: ']
+                self.SENTENCES_PREFIX = ('Input food: ', 'Output meal: ')
             elif self.args.encode_single_food_descrip:
                 self.MODEL_DIR_BASE = 'save/single-food-meal-model'
-                self.SENTENCES_PREFIX = ['Input food: ', 'Output meal: ']
+                self.SENTENCES_PREFIX = ('Input food: ', 'Output meal: ')
             elif self.args.encode_food_ids:
                 self.MODEL_DIR_BASE = 'save/foodID-meal-model'
-                self.SENTENCES_PREFIX = ['Input food: ', 'Output meal: ']
+                self.SENTENCES_PREFIX = ('Input food: ', 'Output meal: ')
             else:
                 self.MODEL_DIR_BASE = 'save/meal-model'
-                self.SENTENCES_PREFIX = ['Input meal: ', 'Output meal: ']
+                self.SENTENCES_PREFIX = ('Input meal: ', 'Output meal: ')
 
         elif self.args.corpus == 'healthy-comments':
             self.args.maxLength = 100
@@ -213,7 +254,7 @@ class Chatbot:
                 self.MODEL_DIR_BASE = 'save/healthy-comments-flag'
             elif self.args.encode_food_ids:
                 self.MODEL_DIR_BASE = 'save/healthy-comments-foodID'
-            self.SENTENCES_PREFIX = ['Input meal: ', 'Output comment: ']
+            self.SENTENCES_PREFIX = ('Input meal: ', 'Output comment: ')
             self.TEST_IN_NAME = 'data/test/healthy_comments_test.txt'
 
         if self.args.motivate_only:
@@ -278,14 +319,14 @@ class Chatbot:
 
         if self.args.MMI:
             # create bigram language model for MMI scoring of decoder output
-            self.probDist = nltk.ConditionalProbDist(nltk.ConditionalFreqDist(nltk.bigrams(self.textData.responseWords)), nltk.MLEProbDist)
+            self._buildBigramTable()
 
         with tf.device(self.getDevice()):
             self.model = Model(self.args, self.textData)
 
         # Saver/summaries
         self.writer = tf.summary.FileWriter(self._getSummaryName())
-        self.saver = tf.train.Saver(max_to_keep=200, write_version=tf.train.SaverDef.V1)  # Arbitrary limit ?
+        self.saver = tf.train.Saver(max_to_keep=self.args.maxCheckpoints or None, write_version=tf.train.SaverDef.V2)
 
         # TODO: Fixed seed (WARNING: If dataset shuffling, make sure to do that after saving the
         # dataset, otherwise, all which cames after the shuffling won't be replicable when
@@ -294,7 +335,7 @@ class Chatbot:
 
         # Running session
 
-        self.sess = tf.Session()  # TODO: Replace all sess by self.sess (not necessary a good idea) ?
+        self.sess = tf.Session(config=self.getSessionConfig())  # TODO: Replace all sess by self.sess (not necessary a good idea) ?
 
         print('Initialize variables...')
         self.sess.run(tf.global_variables_initializer())
@@ -303,6 +344,10 @@ class Chatbot:
         if self.args.test != Chatbot.TestMode.ALL:
             self.managePreviousModel(self.sess)
 
+        # The weights won't change anymore, single predictions can run on a frozen graph
+        if self.args.test in (Chatbot.TestMode.INTERACTIVE, Chatbot.TestMode.DAEMON):
+            self._freezeInferenceGraph()
+
         if self.args.test:
             if self.args.test == Chatbot.TestMode.INTERACTIVE:
                 self.mainTestInteractive(self.sess)
@@ -319,6 +364,8 @@ class Chatbot:
 
         if self.args.test != Chatbot.TestMode.DAEMON:
             self.sess.close()
+            if self.inferenceSess:
+                self.inferenceSess.close()
             print("The End! Thanks for using this program")
 
     def mainTrain(self, sess):
@@ -332,13 +379,28 @@ class Chatbot:
         self.textData.makeLighter(self.args.ratioDataset)  # Limit the number of training samples
 
         mergedSummaries = tf.summary.merge_all()  # Define the summary operator (Warning: Won't appear on the tensorboard graph)
+        if not self.args.summaryEvery:
+            self.args.summaryEvery = max(1, self.args.saveEvery // 10)
         if self.globStep == 0:  # Not restoring from previous run
             self.writer.add_graph(sess.graph)  # First time only
+        self._buildCheckpointWriter()
 
         # If restoring a model, restore the progression bar ? and current batch ?
 
         print('Start training (press Ctrl+C to save and exit)...')
 
+        # Hot loop bookkeeping kept in locals (self.globStep is synchronized before each save)
+        sessRun = sess.run
+        addSummary = self.writer.add_summary
+        saveEvery = self.args.saveEvery
+        summaryEvery = self.args.summaryEvery
+        globStep = self.globStep
+        nextSave = (globStep // saveEvery + 1) * saveEvery
+        nextSummary = -(-globStep // summaryEvery) * summaryEvery  # First multiple of summaryEvery not yet reached
+        ops, feedDict = self.model.step(None)  # The batches are read from the input queue, so the ops never change
+        assert len(ops) == 2  # training, loss
+        summaryOps = ops + (mergedSummaries,)
+
         try:  # If the user exit while training, we still try to save the model
             for e in range(self.args.numEpochs):
 
@@ -349,26 +411,86 @@ class Chatbot:
 
                 # TODO: Also update learning parameters eventually
 
-                tic = datetime.datetime.now()
-                for nextBatch in tqdm(batches, desc="Training"):
-                    # Training pass
-                    ops, feedDict = self.model.step(nextBatch)
-                    assert len(ops) == 2  # training, loss
-                    _, loss, summary = sess.run(ops + (mergedSummaries,), feedDict)
-                    self.writer.add_summary(summary, self.globStep)
-                    self.globStep += 1
-
-                    # Checkpoint
-                    if self.globStep % self.args.saveEvery == 0:
-                        self._saveSession(sess)
+                # The batches are pushed into the model input queue in background, while the training steps run
+                self.feederError = None
+                nbBatches = self.textData.getBatchCount()
+                feeder = threading.Thread(target=self._feedBatches, args=(sess, batches, nbBatches), daemon=True)
+                feeder.start()
 
+                tic = datetime.datetime.now()
+                try:
+                    for _ in tqdm(range(nbBatches), desc="Training"):
+                        # Training pass
+                        if globStep >= nextSummary:  # The summaries are only computed when logged
+                            _, loss, summary = sessRun(summaryOps, feedDict)
+                            addSummary(summary, globStep)
+                            nextSummary += summaryEvery
+                        else:
+                            _, loss = sessRun(ops, feedDict)
+                        globStep += 1
+
+                        # Checkpoint
+                        if globStep >= nextSave:
+                            self.globStep = globStep
+                            self._saveSession(sess)
+                            nextSave += saveEvery
+                except (tf.errors.OutOfRangeError, tf.errors.CancelledError):  # The queue has been closed by the feeder
+                    feeder.join()
+                    if self.feederError is None:
+                        raise RuntimeError('The batch feeder stopped before the end of the epoch')
+                    raise self.feederError
+                except Exception:  # Unblock the feeder thread before exiting
+                    self._closeInputQueue(sess)
+                    raise
+
+                feeder.join()
+                if self.feederError is not None:  # Failed after having pushed its last batch
+                    raise self.feederError
                 toc = datetime.datetime.now()
 
                 print("Epoch finished in {}".format(toc-tic))  # Warning: Will overflow if an epoch takes more than 24 hours, and the output isn't really nicer
         except (KeyboardInterrupt, SystemExit):  # If the user press Ctrl+C while testing progress
             print('Interruption detected, exiting the program...')
+            self._closeInputQueue(sess)  # Unblock the feeder thread
 
+        self.globStep = globStep
         self._saveSession(sess)  # Ultimate saving before complete exit
+        self._waitCheckpoint()
+        self.checkpointPool.shutdown()
+        self.checkpointSess.close()
+
+    def _feedBatches(self, sess, batches, nbBatches):
+        """ Push the training batches into the model input queue (run on a background thread)
+        The batches are created here, while the training steps run. If the feeder stops before having pushed all the
+        batches, the queue is closed, so the training loop gets an OutOfRangeError instead of waiting forever
+        Args:
+            sess: The current running session
+            batches (generator<Batch>): the batches of the current epoch
+            nbBatches (int): the number of batches the training loop will read
+        """
+        nbPushed = 0
+        try:
+            for batch in batches:
+                enqueueOp, feedDict = self.model.enqueue(batch)
+                sess.run(enqueueOp, feedDict)
+                nbPushed += 1
+        except tf.errors.CancelledError:  # The queue has been closed (training interrupted)
+            pass
+        except Exception as error:  # Kept for the training loop
+            self.feederError = error
+        finally:
+            if nbPushed < nbBatches:
+                self._closeInputQueue(sess)
+
+    def _closeInputQueue(self, sess):
+        """ Close the model input queue, cancelling the pending enqueues (does nothing if already closed)
+        Args:
+            sess: The current running session
+        """
+        try:
+            sess.run(self.model.closeQueueOp)
+        except tf.errors.CancelledError:  # Already closed
+            pass
 
     def predictTestset(self, sess):
         """ Try predicting the sentences from the samples.txt file.
@@ -383,26 +505,35 @@ class Chatbot:
             return
 
         if self.args.corpus == 'healthy-comments':
-            lines = []
             responses = None
-            responses_motivate = []
-            responses_advice = []
             corpusDir = '/usr/users/korpusik/nutrition/Talia_data/'
             files = ['salad1.csv', 'salad2.csv', 'salad3.csv', 'dinner1.csv', 'dinner2.csv', 'dinner3.csv', 'pasta1.csv', 'pasta2.csv', 'pasta3.csv', 'pasta4.csv']
-            count = 0
-            for filen in files:
-                csvfile = open(corpusDir + filen)
-                reader = csv.DictReader(csvfile)
-            
-                for row in reader:
-                    count += 1
-                    # use every 10th line for testing
-                    if count % 10 != 0:
-                        continue
-                    #print(row['Input.meal_response'])
-                    lines.append(row['Input.meal_response'])
-                    responses_motivate.append(row['Answer.description1'])
-                    responses_advice.append(row['Answer.description2'])
+            columns = ['Input.meal_response', 'Answer.description1', 'Answer.description2']
+            if pd is not None:
+                dataFrame = pd.concat([
+                    pd.read_csv(corpusDir + filen, usecols=columns, dtype=str, keep_default_na=False) for filen in files
+                ], ignore_index=True)
+                dataFrame = dataFrame.iloc[9::10]  # use every 10th line for testing
+                lines = dataFrame['Input.meal_response'].tolist()
+                responses_motivate = dataFrame['Answer.description1'].tolist()
+                responses_advice = dataFrame['Answer.description2'].tolist()
+            else:  # Plain rows, the columns are picked by index
+                lines = []
+                responses_motivate = []
+                responses_advice = []
+                count = 0
+                for filen in files:
+                    with open(corpusDir + filen, newline='') as csvfile:
+                        reader = csv.reader(csvfile)
+                        mealIdx, motivateIdx, adviceIdx = [next(reader).index(column) for column in columns]
+                        for row in reader:
+                            count += 1
+                            # use every 10th line for testing
+                            if count % 10 != 0:
+                                continue
+                            lines.append(row[mealIdx])
+                            responses_motivate.append(row[motivateIdx])
+                            responses_advice.append(row[adviceIdx])
             assert len(lines) == len(responses_motivate) == len(responses_advice)
         else:
             # Loading the file to predict
@@ -410,6 +541,26 @@ class Chatbot:
                 lines = f.readlines()
                 responses = None
 
+        # The references and the input batches don't depend on the model, so they are only computed once (the
+        # reference files are still written next to each model predictions)
+        if self.args.corpus == 'healthy-comments':
+            references = {
+                '_reference_motivate.txt': ''.join(response+'\n' for response in responses_motivate),
+                '_reference_advice.txt': ''.join(response+'\n' for response in responses_advice),
+            }
+        else:
+            references = {self.REFERENCES_SUFFIX: ''.join(response+'\n' for response in responses or [])}
+
+        questions = [line[:-1] for line in lines]  # Remove the endl character
+        if self.args.corpus == 'healthy-comments':
+            with open('test_meals.txt', 'w', buffering=self.OUTPUT_BUFFER_SIZE) as meal_f:
+                meal_f.writelines(question+'\n' for question in questions)
+
+        chunks = []
+        for start in tqdm(range(0, len(questions), self.TEST_BATCH_SIZE), desc='Encoding'):
+            chunkQuestions = questions[start:start+self.TEST_BATCH_SIZE]
+            chunks.append((chunkQuestions, self.encodeQuestions(chunkQuestions)))
+
         # Predicting for each model present in modelDir
         meal_response_map = {} # maps meals to list of candidate responses
         for modelName in sorted(modelList):  # TODO: Natural sorting
@@ -421,47 +572,33 @@ class Chatbot:
             if self.args.MMI:
                 saveName += '_MMI_'+str(self.args.lambda_wt)+'_'+str(self.args.gamma_wt)
             saveName += '.txt'
-            if self.args.corpus == 'healthy-comments':
-                reference_f1 = open(modelName[:-len(self.MODEL_EXT)] + '_reference_motivate.txt', 'w')
-                reference_f2 = open(modelName[:-len(self.MODEL_EXT)] + '_reference_advice.txt', 'w')
-                meal_f = open('test_meals.txt', 'w')
-            else:
-                reference_f = open(modelName[:-len(self.MODEL_EXT)] + self.REFERENCES_SUFFIX, 'w')
-            with open(saveName, 'w') as f:
-                nbIgnored = 0
-                for i, line in enumerate(tqdm(lines, desc='Sentences')):
-                    question = line[:-1]  # Remove the endl character
-                    if responses:
-                        response = responses[i]
-                        reference_f.write(response+'\n')
-                    elif self.args.corpus == 'healthy-comments':
-                        reference_f1.write(responses_motivate[i]+'\n')
-                        reference_f2.write(responses_advice[i]+'\n')
-                        meal_f.write(question+'\n')
-
-                    answer, predict_responses = self.singlePredict(question)
+            for suffix, content in references.items():
+                with open(modelName[:-len(self.MODEL_EXT)] + suffix, 'w', buffering=self.OUTPUT_BUFFER_SIZE) as reference_f:
+                    reference_f.write(content)
+            nbIgnored = 0
+            outputs = []  # Written at once at the end
+            for chunkQuestions, encodedQuestions in tqdm(chunks, desc='Sentences'):
+                predictions = self.batchPredict(chunkQuestions, encodedQuestions)
+                for question, (answer, predict_responses) in zip(chunkQuestions, predictions):
                     if not answer:
                         nbIgnored += 1
                         continue  # Back to the beginning, try again
-                    
+
                     output = self.textData.sequence2str(answer, clean=True)
                     predict_responses = [self.textData.sequence2str(reply, clean=True) for reply in predict_responses]
                     meal_response_map[question] = predict_responses
-                    predString = '{x[0]}{0}\n{x[1]}{1}\n\n'.format(question, output, x=self.SENTENCES_PREFIX)
+                    predString = '{x[0]}{0}\n{x[1]}{1}\n\n'.format(question, output, x=self.sentencesPrefix)
                     if self.args.verbose:
                         tqdm.write(predString)
-                    f.write(output+'\n')
-                    
-                print('Prediction finished, {}/{} sentences ignored (too long)'.format(nbIgnored, len(lines)))
-            if self.args.corpus == 'healthy-comments':
-                reference_f1.close()
-                reference_f2.close()
-                meal_f.close()
-            else:
-                reference_f.close()
+                    outputs.append(output+'\n')
+
+            with open(saveName, 'w', buffering=self.OUTPUT_BUFFER_SIZE) as f:
+                f.writelines(outputs)
+            print('Prediction finished, {}/{} sentences ignored (too long)'.format(nbIgnored, len(lines)))
 
-        with open(modelName[:-len(self.MODEL_EXT)] + 'predict_candidates.json', 'w') as fp:
-            json.dump(meal_response_map, fp)
+        # json.dump encodes the map chunk by chunk into the buffered file (no intermediate string)
+        with open(modelName[:-len(self.MODEL_EXT)] + 'predict_candidates.json', 'w', encoding='utf-8', buffering=self.OUTPUT_BUFFER_SIZE) as fp:
+            json.dump(meal_response_map, fp, separators=(',', ':'), ensure_ascii=False)
 
         print('Output: ', modelName[:-len(self.MODEL_EXT)] + self.TEST_OUT_SUFFIX)
         print('Refs: ', modelName[:-len(self.MODEL_EXT)] + self.REFERENCES_SUFFIX)
@@ -481,7 +618,7 @@ class Chatbot:
               'expectation. Type \'exit\' or just press ENTER to quit the program. Have fun.')
 
         while True:
-            question = input(self.SENTENCES_PREFIX[0])
+            question = input(self.sentencesPrefix[0])
             if question == '' or question == 'exit':
                 break
 
@@ -491,7 +628,7 @@ class Chatbot:
                 print('Warning: sentence too long, sorry. Maybe try a simpler sentence.')
                 continue  # Back to the beginning, try again
 
-            print('{}{}'.format(self.SENTENCES_PREFIX[1], self.textData.sequence2str(answer, clean=True)))
+            print('{}{}'.format(self.sentencesPrefix[1], self.textData.sequence2str(answer, clean=True)))
 
             if self.args.verbose:
                 print(self.textData.batchSeq2str(questionSeq, clean=True, reverse=True))
@@ -514,85 +651,219 @@ class Chatbot:
         if questionSeq is not None:  # If the caller want to have the real input
             questionSeq.extend(batch.encoderSeqs)
 
+        return self._predictBatch(batch)[0]
+
+    def batchPredict(self, questions, encodedQuestions=None):
+        """ Predict the answers of multiple sentences at once
+        Args:
+            questions (list<str>): the raw input sentences
+            encodedQuestions (list<(Batch, list<int>)>): the questions already encoded by encodeQuestions(). If not
+            given, the questions are encoded here
+        Return:
+            list<(list<int>, list<list<int>>)>: the answer and the candidates of each question ((None, []) if the
+            sentence could not be encoded)
+        """
+        if encodedQuestions is None:
+            encodedQuestions = self.encodeQuestions(questions)
+
+        predictions = [(None, [])] * len(questions)
+        for batch, questionIds in encodedQuestions:
+            for questionId, prediction in zip(questionIds, self._predictBatch(batch)):
+                predictions[questionId] = prediction
+
+        return predictions
+
+    def encodeQuestions(self, questions):
+        """ Create the input batches for the given sentences
+        With beam search, the decoder graph only handles one sentence at a time (the beam is the batch dimension), so
+        each sentence has its own batch. Otherwise, all the sentences are grouped in a single batch
+        Args:
+            questions (list<str>): the raw input sentences
+        Return:
+            list<(Batch, list<int>)>: the batches, with the position (in questions) of each of their sequences
+        """
+        if self.args.beam_search:
+            encodedQuestions = []
+            for i, question in enumerate(questions):
+                batch = self.textData.sentence2enco(question)
+                if batch:
+                    encodedQuestions.append((batch, [i]))
+            return encodedQuestions
+
+        batch, questionIds = self.textData.batchSentence2enco(questions)
+        return [(batch, questionIds)] if batch else []
+
+    def _predictBatch(self, batch):
+        """ Run the model on the given input batch
+        Args:
+            batch (Batch): the encoded input sentences (a single one with beam search)
+        Return:
+            list<(list<int>, list<list<int>>)>: the answer and the candidates of each sentence of the batch
+        """
         # Run the model
         ops, feedDict = self.model.step(batch, self.args.match_encoder_decoder_input)
-        output = self.sess.run(ops[0], feedDict)  # TODO: Summarize the output too (histogram, ...)
-        candidates = []
+        if self.inferenceSess:  # The placeholders not used by the outputs have been pruned from the frozen graph
+            output = self.inferenceSess.run(self.inferenceOutputs, {
+                self.inferenceInputs[placeholder]: value for placeholder, value in feedDict.items() if placeholder in self.inferenceInputs
+            })
+        else:
+            output = self.sess.run(ops[0], feedDict)  # TODO: Summarize the output too (histogram, ...)
         if self.args.beam_search:
-            # print all candidates in beam
-            probs, path, symbol, output = output[-1], output[-3], output[-2], output[:-3]
-            #print('probs', probs)
-            #print('path', path)
-            #print('symbol', symbol)
-            
-            paths = []
-            log_probs = [] # total log prob of each candidate path
-            num_steps = len(path)
-            lastTokenIndex = [num_steps]*self.args.beam_size
-            for kk in range(self.args.beam_size):
-                paths.append([])
-                log_probs.append(0.0)
-                for i in range(num_steps-1):
-                    if symbol[i][kk] == self.textData.eosToken:
-                        lastTokenIndex[kk] = i
-                        break
-            curr = list(range(self.args.beam_size))
-            for i in range(num_steps-1, -1, -1):
-                for kk in range(self.args.beam_size):
-                    if i > lastTokenIndex[kk]:
-                        continue
-                    paths[kk].append(symbol[i][curr[kk]])
-                    log_probs[kk] = log_probs[kk] + probs[i][curr[kk]]
-                    curr[kk] = path[i][curr[kk]]
-
-            #print ("Replies ---------------------->")
-            reply_score_map = {}
-            best_score = None
-            for kk in range(self.args.beam_size):
-                foutputs = [int(logit) for logit in paths[kk][::-1]]
-                candidates.append(foutputs)
-                #print(foutputs)
-                reply = self.textData.sequence2str(foutputs, clean=True)
-                if reply in reply_score_map:
-                    continue
-                if self.args.MMI:
-                    length_term = self.args.gamma_wt * len(paths[kk])
-                    log_LM_penalty = 0.0
-                    prevWord = "<start>"
-                    for wordID in foutputs[:self.args.gamma_wt]:
-                        currWord = self.textData.id2word[wordID]
-                        bigramP = self.probDist[prevWord].prob(currWord)
-                        # TODO: try Kneser-Ney smoothing
-                        if bigramP > 0:
-                            log_LM_penalty += math.log(bigramP)
-                        prevWord = currWord
-                    # TODO: try with product of probs instead of sum of logs
-                    LM_term = self.args.lambda_wt * log_LM_penalty
-                    score = log_probs[kk] - LM_term + length_term
-                    reply_score_map[reply] = score
-                    #print(score, log_probs[kk], LM_term, length_term, reply)
-                else:
-                    print(reply)
-                    score = log_probs[kk]
-                    reply_score_map[reply] = log_probs[kk]
-                if kk == 0:
-                    answer = foutputs
-                    best_score = score
-                elif score > best_score:
-                    answer = foutputs
-                    best_score = score
-            # rerank replies based on MMI scores
-            if self.args.MMI:
-                sorted_replies = sorted(reply_score_map.items(), key=operator.itemgetter(1), reverse=True)
-                for i, (reply, score) in enumerate(sorted_replies):
-                    if self.args.test == 'interactive':
-                        print(i, score, reply)
+            return [self._beamSearchPredict(output)]
+
+        predictions = []
+        for j in range(len(batch.encoderSeqs[0])):  # Batch size
+            answer = self.textData.deco2sentence([out[j] for out in output])
+            predictions.append((answer, [answer]))
+        return predictions
+
+    def _freezeInferenceGraph(self):
+        """ Convert the variables of the testing graph into constants and load the result in its own session, used
+        afterward by the predictions. The frozen graph only lives in memory (the model directory can be read-only)
+        """
+        print('Freezing the inference graph...')
+        outputs = self.model.outputs
+        graphDef = tf.graph_util.convert_variables_to_constants(
+            self.sess,
+            self.sess.graph.as_graph_def(),
+            [output.op.name for output in outputs]
+        )
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graphDef, name='')
+
+        # Cache the tensor handles
+        nodeNames = {node.name for node in graphDef.node}
+        placeholders = self.model.encoderInputs + self.model.decoderInputs + self.model.decoderTargets + self.model.decoderWeights
+        if self.model.decoderContext:
+            placeholders += self.model.decoderContext
+        self.inferenceInputs = {
+            placeholder: graph.get_tensor_by_name(placeholder.name) for placeholder in placeholders if placeholder.op.name in nodeNames
+        }
+        self.inferenceOutputs = [graph.get_tensor_by_name(output.name) for output in outputs]
+        self.inferenceSess = tf.Session(graph=graph, config=self.getSessionConfig())
+
+    def _beamSearchPredict(self, output):
+        """ Extract the candidates from the beam search decoder outputs and select the best one
+        Args:
+            output (list<np.array>): the model outputs (with the beam path, symbols and probabilities at the end)
+        Return:
+            list<int>: the word ids corresponding to the answer
+            list<list<int>>: the word ids of all the candidates
+        """
+        # print all candidates in beam
+        probs, path, symbol = output[-1], output[-3], output[-2]
+        #print('probs', probs)
+        #print('path', path)
+        #print('symbol', symbol)
+        
+        # Backtrace all the beams at once: each step is a single gather along the beam axis
+        probs, path, symbol = np.asarray(probs), np.asarray(path), np.asarray(symbol)  # Shape [num_steps, beam_size]
+        num_steps = len(path)
+        eosMask = symbol[:-1] == self.textData.eosToken
+        lastTokenIndex = np.where(eosMask.any(axis=0), eosMask.argmax(axis=0), num_steps)
+        outSymbols = np.zeros_like(symbol)
+        log_probs = np.zeros(self.args.beam_size) # total log prob of each candidate path
+        curr = np.arange(self.args.beam_size)
+        for i in range(num_steps-1, -1, -1):
+            active = i <= lastTokenIndex  # Beams are ignored after their <eos>
+            outSymbols[i] = symbol[i, curr]
+            log_probs += np.where(active, probs[i, curr], 0.0)
+            curr = np.where(active, path[i, curr], curr)
+        paths = [outSymbols[:lastTokenIndex[kk]+1, kk] for kk in range(self.args.beam_size)]
+
+        if self.args.MMI:
+            # MMI score of all candidates at once: log p(T|S) - lambda log p(T) + gamma |T|
+            lengths = np.minimum(lastTokenIndex + 1, num_steps)
+            scores = log_probs - self.args.lambda_wt * self._bigramPenalty(outSymbols.T, lengths) + self.args.gamma_wt * lengths
         else:
-            answer = self.textData.deco2sentence(output)
-            candidates.append(answer)
+            scores = log_probs
+
+        #print ("Replies ---------------------->")
+        candidates = []
+        reply_score_map = {}
+        best_score = None
+        for kk in range(self.args.beam_size):
+            foutputs = paths[kk].tolist()
+            candidates.append(foutputs)
+            #print(foutputs)
+            reply = self.textData.sequence2str(paths[kk], clean=True)
+            if reply in reply_score_map:
+                continue
+            if not self.args.MMI:
+                print(reply)
+            score = scores[kk]
+            reply_score_map[reply] = score
+            #print(score, log_probs[kk], reply)
+            if kk == 0:
+                answer = foutputs
+                best_score = score
+            elif score > best_score:
+                answer = foutputs
+                best_score = score
+        # rerank replies based on MMI scores (only the best ones are shown)
+        if self.args.MMI and self.args.test == Chatbot.TestMode.INTERACTIVE:
+            top_replies = heapq.nlargest(self.NB_RERANKED_REPLIES, reply_score_map.items(), key=operator.itemgetter(1))
+            for i, (reply, score) in enumerate(top_replies):
+                print(i, score, reply)
 
         return answer, candidates
 
+    def _buildBigramTable(self):
+        """ Build the bigram language model (maximum likelihood estimate) of the responses, as a sorted lookup table
+        of word ids, so the LM penalty of all the beam candidates can be computed with a few array operations
+        Only the observed bigrams are kept (unseen bigrams don't penalize the score)
+        """
+        vocabSize = self.textData.getVocabularySize()
+        self.bigramStartId = vocabSize
+        unknownId = vocabSize + 1  # Words never generated by the decoder
+
+        words = self.textData.responseWords
+        word2id = self.textData.word2id
+        ids = np.fromiter(
+            (self.bigramStartId if word == '<start>' else word2id.get(word, unknownId) for word in words),
+            dtype=np.int64,
+            count=len(words)
+        )
+        prevIds, currIds = ids[:-1], ids[1:]
+        prevCounts = np.bincount(prevIds, minlength=unknownId + 1)  # Number of bigrams starting with each word
+
+        valid = (prevIds != unknownId) & (currIds < vocabSize)
+        self.bigramKeys, counts = np.unique(prevIds[valid] * (vocabSize + 1) + currIds[valid], return_counts=True)
+        self.bigramLogProbs = np.log(counts / prevCounts[self.bigramKeys // (vocabSize + 1)])
+
+    def _bigramLogProb(self, prevIds, currIds):
+        """ Vectorized lookup on the bigram table
+        Args:
+            prevIds (np.array<int>): the previous word ids
+            currIds (np.array<int>): the current word ids (same shape as prevIds)
+        Return:
+            np.array<float>: log P(curr|prev) for each pair (0 for the unseen bigrams)
+        """
+        queries = np.asarray(prevIds, dtype=np.int64) * (self.bigramStartId + 1) + np.asarray(currIds, dtype=np.int64)
+        if not len(self.bigramKeys):
+            return np.zeros(queries.shape)
+        idx = np.minimum(np.searchsorted(self.bigramKeys, queries), len(self.bigramKeys) - 1)
+        return np.where(self.bigramKeys[idx] == queries, self.bigramLogProbs[idx], 0.0)
+
+    def _bigramPenalty(self, symbols, lengths):
+        """ Compute the LM log-probability of the first gamma_wt words of each candidate
+        The candidates are padded into a dense [beam_size, gamma_wt+1] matrix (starting with <start>) so all the
+        bigrams are looked up at once
+        Args:
+            symbols (np.array<int>): the candidates word ids (shape [beam_size, num_steps])
+            lengths (np.array<int>): the true length of each candidate
+        Return:
+            np.array<float>: the log LM penalty of each candidate
+        """
+        prefixLength = min(self.args.gamma_wt, symbols.shape[1])
+        candidates = np.full((symbols.shape[0], self.args.gamma_wt + 1), self.bigramStartId, dtype=np.int64)
+        candidates[:, 1:prefixLength+1] = symbols[:, :prefixLength]
+        mask = np.arange(self.args.gamma_wt) < np.minimum(lengths, self.args.gamma_wt)[:, None]  # Ignore the padding
+        # TODO: try Kneser-Ney smoothing
+        return np.sum(self._bigramLogProb(candidates[:, :-1], candidates[:, 1:]) * mask, axis=1)
+
     def daemonPredict(self, sentence):
         """ Return the answer to a given sentence (same as singlePredict() but with additional cleaning)
         Args:
@@ -610,6 +881,8 @@ class Chatbot:
         """
         print('Exiting the daemon mode...')
         self.sess.close()
+        if self.inferenceSess:
+            self.inferenceSess.close()
         print('Daemon closed.')
 
     def managePreviousModel(self, sess):
@@ -630,16 +903,25 @@ class Chatbot:
         print('WARNING: ', end='')
 
         modelName = self._getModelName()
+        cleanMarker = os.path.join(self.modelDir, self.CLEAN_MARKER_FILENAME)
+        if not self.args.reset and os.path.exists(cleanMarker):  # Reset by a previous run, no model saved since
+            print('No previous model found, starting from clean directory: {}'.format(self.modelDir))
+            self.modelDirClean = True
+            return
 
-        if os.listdir(self.modelDir):
+        modelFiles = self._scanModelDir()  # Single directory read, shared by all the checks below
+
+        if modelFiles:
+            fileNames = {entry.name for entry in modelFiles}
+            modelFileName = os.path.basename(modelName)
             if self.args.reset:
                 print('Reset: Destroying previous model at {}'.format(self.modelDir))
             # Analysing directory content
-            elif os.path.exists(modelName):  # Restore the model
+            elif modelFileName + self.MODEL_INDEX_EXT in fileNames or modelFileName in fileNames:  # Restore the model (V2 or V1 checkpoint)
                 print('Restoring previous model from {}'.format(modelName))
                 self.saver.restore(sess, modelName)  # Will crash when --reset is not activated and the model has not been saved yet
                 print('Model restored.')
-            elif self._getModelList():
+            elif self._getModelList(modelFiles):
                 print('Conflict with previous models.')
                 raise RuntimeError('Some models are already present in \'{}\'. You should check them first (or re-try with the keepAll flag)'.format(self.modelDir))
             else:  # No other model to conflict with (probably summary files)
@@ -647,28 +929,94 @@ class Chatbot:
                 self.args.reset = True
 
             if self.args.reset:
-                fileList = [os.path.join(self.modelDir, f) for f in os.listdir(self.modelDir)]
-                for f in fileList:
-                    print('Removing {}'.format(f))
-                    os.remove(f)
+                print('\n'.join('Removing {}'.format(entry.path) for entry in modelFiles))
+                shutil.rmtree(self.modelDir)  # Fails loudly rather than training on top of stale checkpoints
+                os.makedirs(self.modelDir, exist_ok=True)
+                open(cleanMarker, 'w').close()  # The next runs won't need to scan the directory until a model is saved
+                self.modelDirClean = True
 
         else:
             print('No previous model found, starting from clean directory: {}'.format(self.modelDir))
 
     def _saveSession(self, sess):
         """ Save the model parameters and the variables
+        The variables are copied from the session, then written on background (the previous checkpoint is awaited first)
         Args:
             sess: the current session
         """
-        tqdm.write('Checkpoint reached: saving model (don\'t stop the run)...')
-        self.saveModelParams()
-        self.saver.save(sess, self._getModelName())  # TODO: Put a limit size (ex: 3GB for the modelDir)
-        tqdm.write('Model saved.')
+        self._waitCheckpoint()
+        values = sess.run(self.checkpointVariables)
+        if self.modelDirClean:  # The directory now contains a model
+            os.remove(os.path.join(self.modelDir, self.CLEAN_MARKER_FILENAME))
+            self.modelDirClean = False
+        self.checkpointFuture = self.checkpointPool.submit(self._writeCheckpoint, values, self._getModelName(), self.globStep)
+
+    def _writeCheckpoint(self, values, modelName, globStep):
+        """ Write the copied variables into a checkpoint (run on the checkpoint thread)
+        The step is only logged once the checkpoint is written, so the restored globStep always has its model
+        Args:
+            values (list<np.array>): the values of the model variables
+            modelName (str): the checkpoint path
+            globStep (int): the step of the checkpoint
+        """
+        tic = datetime.datetime.now()
+        initializers, placeholders = zip(*self.checkpointInputs)
+        self.checkpointSess.run(initializers, dict(zip(placeholders, values)))
+        # The graph is rebuilt from the code when restoring, so only the variables (.index and .data) are written
+        self.checkpointSaver.save(self.checkpointSess, modelName, write_meta_graph=False)  # The oldest models are pruned by the saver (--maxCheckpoints)
+        if not self.modelParamsSaved:  # Afterwards, only the globStep changes
+            self.saveModelParams(globStep)
+            self.modelParamsSaved = True
+        with open(os.path.join(self.modelDir, self.STEP_LOG_FILENAME), 'ab', buffering=0) as stepLog:
+            stepLog.write('{}\n'.format(globStep).encode())
+        tqdm.write('Checkpoint reached: model saved in {}'.format(datetime.datetime.now() - tic))
+
+    def _waitCheckpoint(self):
+        """ Block until the checkpoint in progress (if any) is written
+        """
+        if self.checkpointFuture is not None:
+            self.checkpointFuture.result()  # Also raise the errors of the checkpoint thread
+            self.checkpointFuture = None
+
+    def _buildCheckpointWriter(self):
+        """ Create the copy of the model variables from which the checkpoints are written
+        The copies are on cpu, in a separate graph (with the same variable names, so the checkpoints are restored by the
+        main saver)
+        """
+        self.checkpointVariables = tf.global_variables()
+        graph = tf.Graph()
+        with graph.as_default(), tf.device('/cpu:0'):
+            self.checkpointInputs = []
+            copies = {}
+            for variable in self.checkpointVariables:
+                placeholder = tf.placeholder(variable.dtype.base_dtype, variable.get_shape())
+                copy = tf.Variable(placeholder, name=variable.op.name, trainable=False)
+                self.checkpointInputs.append((copy.initializer, placeholder))
+                copies[variable.op.name] = copy
+            self.checkpointSaver = tf.train.Saver(copies, max_to_keep=self.args.maxCheckpoints or None, write_version=tf.train.SaverDef.V2)
+        self.checkpointSess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+        self.checkpointPool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _scanModelDir(self):
+        """ List the files of the model directory
+        Return:
+            list<os.DirEntry>: the files inside the model directory
+        """
+        return [entry for entry in os.scandir(self.modelDir) if entry.is_file()]
 
-    def _getModelList(self):
-        """ Return the list of the model files inside the model directory
+    def _getModelList(self, modelFiles=None):
+        """ Return the list of the models inside the model directory (path given to saver.restore())
+        Args:
+            modelFiles (list<os.DirEntry>): the content of the model directory, if already scanned
         """
-        return [os.path.join(self.modelDir, f) for f in os.listdir(self.modelDir) if f.endswith(self.MODEL_EXT)]
+        if modelFiles is None:
+            modelFiles = self._scanModelDir()
+        modelExt = self.MODEL_EXT
+        indexExt = self.MODEL_EXT + self.MODEL_INDEX_EXT
+        indexExtLength = len(self.MODEL_INDEX_EXT)
+        modelList = [entry.path for entry in modelFiles if entry.name.endswith(modelExt)]  # Checkpoint V1 (single file)
+        modelList += [entry.path[:-indexExtLength] for entry in modelFiles if entry.name.endswith(indexExt)]  # Checkpoint V2, the model is identified by its prefix
+        return modelList
 
     def loadModelParams(self):
         """ Load the some values associated with the current model, like the current globStep value
@@ -685,10 +1033,16 @@ class Chatbot:
 
         # If there is a previous model, restore some parameters
         configName = os.path.join(self.modelDir, self.CONFIG_FILENAME)
+        legacyConfigName = os.path.join(self.modelDir, self.CONFIG_LEGACY_FILENAME)
+        if not os.path.exists(configName) and os.path.exists(legacyConfigName):
+            configName = legacyConfigName
         if not self.args.reset and not self.args.createDataset and os.path.exists(configName):
             # Loading
-            config = configparser.ConfigParser()
-            config.read(configName)
+            if configName == legacyConfigName:
+                config = self._loadLegacyModelParams(configName)
+            else:
+                with open(configName, 'r') as configFile:
+                    config = json.load(configFile)
 
             # Check the version
             currentVersion = config['General'].get('version')
@@ -696,15 +1050,20 @@ class Chatbot:
                 raise UserWarning('Present configuration version {0} does not match {1}. You can try manual changes on \'{2}\''.format(currentVersion, self.CONFIG_VERSION, configName))
 
             # Restoring the the parameters
-            self.globStep = config['General'].getint('globStep')
-            self.args.maxLength = config['General'].getint('maxLength')  # We need to restore the model length because of the textData associated and the vocabulary size (TODO: Compatibility mode between different maxLength)
-            self.args.watsonMode = config['General'].getboolean('watsonMode')
+            self.globStep = config['General']['globStep']
+            stepLogName = os.path.join(self.modelDir, self.STEP_LOG_FILENAME)
+            if os.path.exists(stepLogName):  # The steps of the later checkpoints
+                lastStep = self._readLastStep(stepLogName)
+                if lastStep is not None:
+                    self.globStep = lastStep
+            self.args.maxLength = config['General']['maxLength']  # We need to restore the model length because of the textData associated and the vocabulary size (TODO: Compatibility mode between different maxLength)
+            self.args.watsonMode = config['General']['watsonMode']
             #self.args.datasetTag = config['General'].get('datasetTag')
 
-            self.args.hiddenSize = config['Network'].getint('hiddenSize')
-            self.args.numLayers = config['Network'].getint('numLayers')
-            self.args.embeddingSize = config['Network'].getint('embeddingSize')
-            self.args.softmaxSamples = config['Network'].getint('softmaxSamples')
+            self.args.hiddenSize = config['Network']['hiddenSize']
+            self.args.numLayers = config['Network']['numLayers']
+            self.args.embeddingSize = config['Network']['embeddingSize']
+            self.args.softmaxSamples = config['Network']['softmaxSamples']
 
             # No restoring for training params, batch size or other non model dependent parameters
 
@@ -724,34 +1083,92 @@ class Chatbot:
         self.args.maxLengthEnco = self.args.maxLength
         self.args.maxLengthDeco = self.args.maxLength + 2
 
-        if self.args.watsonMode:
-            self.SENTENCES_PREFIX.reverse()
+        self.sentencesPrefix = self.SENTENCES_PREFIX[::-1] if self.args.watsonMode else self.SENTENCES_PREFIX
 
 
-    def saveModelParams(self):
+    def saveModelParams(self, globStep=None):
         """ Save the params of the model, like the current globStep value
         Warning: if you modify this function, make sure the changes mirror loadModelParams
+        Args:
+            globStep (int): the step of the saved checkpoint (by default, the current one)
         """
-        config = configparser.ConfigParser()
-        config['General'] = {}
-        config['General']['version']  = self.CONFIG_VERSION
-        config['General']['globStep']  = str(self.globStep)
-        config['General']['maxLength'] = str(self.args.maxLength)
-        config['General']['watsonMode'] = str(self.args.watsonMode)
+        config = {
+            'General': {
+                'version': self.CONFIG_VERSION,
+                'globStep': self.globStep if globStep is None else globStep,
+                'maxLength': self.args.maxLength,
+                'watsonMode': self.args.watsonMode,
+            },
+            'Network': {
+                'hiddenSize': self.args.hiddenSize,
+                'numLayers': self.args.numLayers,
+                'embeddingSize': self.args.embeddingSize,
+                'softmaxSamples': self.args.softmaxSamples,
+            },
+            # Keep track of the learning params (but without restoring them)
+            'Training (won\'t be restored)': {
+                'learningRate': self.args.learningRate,
+                'batchSize': self.args.batchSize,
+            },
+        }
 
-        config['Network'] = {}
-        config['Network']['hiddenSize'] = str(self.args.hiddenSize)
-        config['Network']['numLayers'] = str(self.args.numLayers)
-        config['Network']['embeddingSize'] = str(self.args.embeddingSize)
-        config['Network']['softmaxSamples'] = str(self.args.softmaxSamples)
+        with open(os.path.join(self.modelDir, self.CONFIG_FILENAME), 'w') as configFile:
+            json.dump(config, configFile, indent=4)
 
-        # Keep track of the learning params (but without restoring them)
-        config['Training (won\'t be restored)'] = {}
-        config['Training (won\'t be restored)']['learningRate'] = str(self.args.learningRate)
-        config['Training (won\'t be restored)']['batchSize'] = str(self.args.batchSize)
+    @staticmethod
+    def _readLastStep(stepLogName):
+        """ Return the globStep of the last checkpoint, from the end of the step log
+        Args:
+            stepLogName (str): the path of the step log
+        Return:
+            int: the last logged globStep, or None if the log does not contain any complete line
+        """
+        with open(stepLogName, 'rb') as stepLog:
+            offset = max(0, os.fstat(stepLog.fileno()).st_size - 64)  # Only the last lines are needed
+            stepLog.seek(offset)
+            lines = stepLog.read().split(b'\n')
+        lines = lines[1 if offset else 0:-1]  # Ignore the partial lines (the one cut by the seek, and the last one if interrupted)
+        for line in reversed(lines):
+            if line.strip().isdigit():
+                return int(line)
+        return None
 
-        with open(os.path.join(self.modelDir, self.CONFIG_FILENAME), 'w') as configFile:
-            config.write(configFile)
+    @staticmethod
+    def _loadLegacyModelParams(configName):
+        """ Read the parameters of a model saved with the previous (.ini) configuration format
+        Args:
+            configName (str): the path of the .ini file
+        Return:
+            dict: the restored parameters, with the same structure and types than the json configuration
+        """
+        sections = {}  # Minimal ini parsing (flat sections written by configparser, no interpolation)
+        section = None
+        with open(configName, 'r') as configFile:
+            for line in configFile:
+                line = line.strip()
+                if not line or line[0] in '#;':
+                    continue
+                if line[0] == '[' and line[-1] == ']':
+                    section = sections.setdefault(line[1:-1], {})
+                elif section is not None and '=' in line:
+                    key, value = line.split('=', 1)
+                    section[key.strip().lower()] = value.strip()  # configparser saved the keys in lower case
+        general = sections['General']
+        network = sections['Network']
+        return {
+            'General': {
+                'version': general.get('version'),
+                'globStep': int(general['globstep']),
+                'maxLength': int(general['maxlength']),
+                'watsonMode': general['watsonmode'].lower() in ('1', 'yes', 'true', 'on'),
+            },
+            'Network': {
+                'hiddenSize': int(network['hiddensize']),
+                'numLayers': int(network['numlayers']),
+                'embeddingSize': int(network['embeddingsize']),
+                'softmaxSamples': int(network['softmaxsamples']),
+            },
+        }
 
     def _getSummaryName(self):
         """ Parse the argument to decide were to save the summary, at the same place that the model
@@ -768,22 +1185,49 @@ class Chatbot:
         Return:
             str: The path and name were the model need to be saved
         """
+        step = self.globStep if self.args.keepAll else None
+        cacheKey, modelName = self.modelNameCache
+        if cacheKey == (self.modelDir, step):  # The name only changes with the step (keepAll) or the directory
+            return modelName
+
         modelName = os.path.join(self.modelDir, self.MODEL_NAME_BASE)
         if self.args.keepAll:  # We do not erase the previously saved model by including the current step on the name
             modelName += '-' + str(self.globStep)
-        return modelName + self.MODEL_EXT
+        modelName += self.MODEL_EXT
+        self.modelNameCache = ((self.modelDir, step), modelName)
+        return modelName
 
     def getDevice(self):
         """ Parse the argument to decide on which device run the model
         Return:
             str: The name of the device on which run the program
         """
-        if self.args.device == 'cpu':
-            return '/cpu:0'
-        elif self.args.device == 'gpu':
-            return '/gpu:0'
-        elif self.args.device is None:  # No specified device (default)
-            return None
+        if self.deviceCache is not None:  # The arguments are only parsed once
+            return self.deviceCache[0]
+
+        device = self.args.device
+        if self.args.test:  # --inferenceDevice first, then --device, and cpu by default
+            device = self.args.inferenceDevice or self.args.device or 'cpu'
+        if device == 'cpu':
+            deviceName = '/cpu:0'
+        elif device == 'gpu':
+            deviceName = '/gpu:0'
+        elif device is None:  # No specified device (default)
+            deviceName = None
         else:
-            print('Warning: Error in the device name: {}, use the default device'.format(self.args.device))
-            return None
+            print('Warning: Error in the device name: {}, use the default device'.format(device))
+            deviceName = None
+        self.deviceCache = (deviceName,)
+        return deviceName
+
+    def getSessionConfig(self):
+        """ Parse the argument to decide how to configure the TensorFlow sessions
+        Return:
+            tf.ConfigProto: The session configuration
+        """
+        config = tf.ConfigProto(allow_soft_placement=True)  # Ops without gpu kernel fall back on cpu
+        config.gpu_options.allow_growth = True  # Allocate the gpu memory on demand (large beams)
+        if self.getDevice() == '/cpu:0':  # Use all the cores for the small matrix operations
+            config.inter_op_parallelism_threads = os.cpu_count()
+            config.intra_op_parallelism_threads = os.cpu_count()
+        return config
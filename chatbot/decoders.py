@@ -121,6 +121,33 @@ def _extract_beam_search(embedding, beam_size, num_symbols, embedding_size,  out
     return emb_prev
   return loop_function
 
+def _beam_search_step(decode_step, carried, finished, log_beam_probs, beam_path, beam_symbols):
+  """Run one beam search decoding step, unless all the beams already produced the EOS symbol.
+  The decoder is statically unrolled, so the remaining steps can't be removed from the graph, but once every beam
+  column has reached EOS, the step is skipped at run time and its (ignored) beam outputs are filled with zeros.
+  Args:
+    decode_step: function(log_beam_probs, beam_path, beam_symbols) running the step, the beam lists are the ones
+      given to the loop function. Returns a flat list of Tensors with the same structure as carried.
+    carried: flat list of the Tensors from the previous step (returned as is when the step is skipped).
+    finished: 1D bool Tensor [beam_size], whether each beam produced EOS during the previous steps.
+    log_beam_probs, beam_path, beam_symbols: the beam search lists, updated in place.
+  Returns:
+    The flat list of the carried Tensors after the step.
+  """
+  def run_step():
+    step_probs, step_path, step_symbols = [log_beam_probs[-1]], [], []
+    step_outputs = decode_step(step_probs, step_path, step_symbols)
+    return list(step_outputs) + [step_probs[-1], step_path[-1], step_symbols[-1]]
+
+  def skip_step():
+    return list(carried) + [array_ops.zeros_like(beam[-1]) for beam in (log_beam_probs, beam_path, beam_symbols)]
+
+  results = control_flow_ops.cond(math_ops.reduce_all(finished), skip_step, run_step)
+  log_beam_probs.append(results[-3])
+  beam_path.append(results[-2])
+  beam_symbols.append(results[-1])
+  return results[:-3]
+
 def _extract_argmax_and_embed(embedding,
                               output_projection=None,
                               update_embedding=True):
@@ -194,7 +221,7 @@ def rnn_decoder(decoder_inputs,
 
 
 def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
-                scope=None,output_projection=None, beam_size=10):
+                scope=None,output_projection=None, beam_size=10, eos_symbol=None):
   """RNN decoder for the sequence-to-sequence model.
   Args:
     decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -227,7 +254,7 @@ def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
     #state_size = cell.state_size
     print('state size', state_size)
 
-    for i, inp in enumerate(decoder_inputs):
+    def decode_step(i, inp, prev, state, log_beam_probs, beam_path, beam_symbols):
       if loop_function is not None and prev is not None:
         with variable_scope.variable_scope("loop_function", reuse=True):
           inp = loop_function(prev, i,log_beam_probs, beam_path, beam_symbols)
@@ -242,16 +269,27 @@ def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
         prev = output
       
       if i==0 and loop_function is not None:
-          states =[]
-          for kk in range(beam_size):
-                states.append(state)
-          state = tf.reshape(tf.concat(states, 0), [-1, state_size])
+          # The first step is shared by all the beams
+          state = tf.tile(tf.reshape(state, [-1, state_size]), [beam_size, 1])
        
       if output_projection:
-        outputs.append(tf.argmax(nn_ops.xw_plus_b(
-          output, output_projection[0], output_projection[1]), dimension=1))
+        output = tf.argmax(nn_ops.xw_plus_b(
+          output, output_projection[0], output_projection[1]), dimension=1)
+      return [output, prev, state]
+
+    finished = None  # Whether each beam produced the EOS symbol (to skip the remaining steps)
+    for i, inp in enumerate(decoder_inputs):
+      if finished is not None:
+        output, prev, state = _beam_search_step(
+          lambda probs, path, symbols: decode_step(i, inp, prev, state, probs, path, symbols),
+          [outputs[-1], prev, state], finished, log_beam_probs, beam_path, beam_symbols)
       else:
-        outputs.append(output)
+        output, prev, state = decode_step(i, inp, prev, state, log_beam_probs, beam_path, beam_symbols)
+      outputs.append(output)
+
+      if eos_symbol is not None and beam_symbols:
+        beam_eos = math_ops.equal(beam_symbols[-1], eos_symbol)
+        finished = beam_eos if finished is None else math_ops.logical_or(finished, beam_eos)
   if loop_function is not None:
     return outputs, state, tf.reshape(tf.concat(beam_path, 0),[-1,beam_size]), tf.reshape(tf.concat(beam_symbols, 0),[-1,beam_size]), tf.reshape(tf.concat(log_beam_probs, 0), [-1, beam_size])
   else:
@@ -261,7 +299,7 @@ def beam_rnn_decoder(decoder_inputs, initial_state, cell, loop_function=None,
 def embedding_rnn_decoder(decoder_inputs, initial_state, cell, num_symbols,
                           embedding_size, output_projection=None,
                           feed_previous=False,
-                          update_embedding_for_previous=True, scope=None, beam_search=True, beam_size=10 ):
+                          update_embedding_for_previous=True, scope=None, beam_search=True, beam_size=10, eos_symbol=None):
   """RNN decoder with embedding and a pure-decoding option.
   Args:
     decoder_inputs: A list of 1D batch-sized int32 Tensors (decoder inputs).
@@ -324,7 +362,7 @@ def embedding_rnn_decoder(decoder_inputs, initial_state, cell, num_symbols,
 
     if beam_search:
         return beam_rnn_decoder(emb_inp, initial_state, cell,
-                       loop_function=loop_function,output_projection=output_projection, beam_size=beam_size)
+                       loop_function=loop_function,output_projection=output_projection, beam_size=beam_size, eos_symbol=eos_symbol)
 
     else:
         return  rnn_decoder(emb_inp, initial_state, cell,
@@ -334,7 +372,7 @@ def embedding_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
                           num_encoder_symbols, num_decoder_symbols,
                           embedding_size, output_projection=None,
                           feed_previous=False, dtype=dtypes.float32,
-                          scope=None, beam_search=True, beam_size=10):
+                          scope=None, beam_search=True, beam_size=10, eos_symbol=None):
   """Embedding RNN sequence-to-sequence model.
   This model first embeds encoder_inputs by a newly created embedding (of shape
   [num_encoder_symbols x input_size]). Then it runs an RNN to encode
@@ -386,7 +424,7 @@ def embedding_rnn_seq2seq(encoder_inputs, decoder_inputs, cell,
     return embedding_rnn_decoder(
           decoder_inputs, encoder_state, cell, num_decoder_symbols,
           embedding_size, output_projection=output_projection,
-          feed_previous=feed_previous, beam_search=beam_search, beam_size=beam_size)
+          feed_previous=feed_previous, beam_search=beam_search, beam_size=beam_size, eos_symbol=eos_symbol)
 
 def beam_attention_decoder(decoder_inputs, 
                            initial_state, 
@@ -400,7 +438,8 @@ def beam_attention_decoder(decoder_inputs,
                            initial_state_attention=False,
                            first_step=False,
                            output_projection=None,
-                           beam_size=10):
+                           beam_size=10,
+                           eos_symbol=None):
   """RNN decoder with attention for the sequence-to-sequence model.
   In this context "attention" means that, during decoding, the RNN can look up
   information in the additional tensor attention_states, and it does this by
@@ -534,7 +573,7 @@ def beam_attention_decoder(decoder_inputs,
 
     log_beam_probs, beam_path, beam_symbols = [],[],[]
 
-    for i, inp in enumerate(decoder_inputs):
+    def decode_step(i, inp, prev, state, attns, log_beam_probs, beam_path, beam_symbols):
       if i > 0:
         variable_scope.get_variable_scope().reuse_variables()
       # If loop_function is set, we use it instead of decoder_inputs.
@@ -562,16 +601,28 @@ def beam_attention_decoder(decoder_inputs,
       if loop_function is not None:
         prev = output
         if i == 0:
-          states =[]
-          for kk in range(beam_size):
-            states.append(state)
-          state = tf.reshape(tf.concat(states, 0), [-1, state_size])
-          with variable_scope.variable_scope(variable_scope.get_variable_scope(), reuse=True):
-            attns = attention(state)
-        outputs.append(tf.argmax(nn_ops.xw_plus_b(
-          output, output_projection[0], output_projection[1]), dimension=1))
+          # The first step is shared by all the beams (the attention reads are the same for each copy of the state)
+          state = tf.tile(tf.reshape(state, [-1, state_size]), [beam_size, 1])
+          attns = [tf.tile(a, [beam_size, 1]) for a in attns]
+        output = tf.argmax(nn_ops.xw_plus_b(
+          output, output_projection[0], output_projection[1]), dimension=1)
+      return [output, prev, state] + attns
+
+    finished = None  # Whether each beam produced the EOS symbol (to skip the remaining steps)
+    for i, inp in enumerate(decoder_inputs):
+      if finished is not None:
+        step_outputs = _beam_search_step(
+          lambda probs, path, symbols: decode_step(i, inp, prev, state, attns, probs, path, symbols),
+          [outputs[-1], prev, state] + attns, finished, log_beam_probs, beam_path, beam_symbols)
       else:
-        outputs.append(output)
+        step_outputs = decode_step(i, inp, prev, state, attns, log_beam_probs, beam_path, beam_symbols)
+      output, prev, state = step_outputs[:3]
+      attns = step_outputs[3:]
+      outputs.append(output)
+
+      if eos_symbol is not None and beam_symbols:
+        beam_eos = math_ops.equal(beam_symbols[-1], eos_symbol)
+        finished = beam_eos if finished is None else math_ops.logical_or(finished, beam_eos)
 
   if loop_function is not None:
     return outputs, state, tf.reshape(tf.concat(beam_path, 0),[-1,beam_size]), tf.reshape(tf.concat(beam_symbols, 0),[-1,beam_size]), tf.reshape(tf.concat(log_beam_probs, 0), [-1, beam_size])
@@ -594,7 +645,8 @@ def beam_embedding_attention_decoder(decoder_inputs,
                                      initial_state_attention=False,
                                      first_step=False,
                                      beam_search=True,
-                                     beam_size=10):
+                                     beam_size=10,
+                                     eos_symbol=None):
 
   """RNN decoder with embedding and attention and a pure-decoding option.
   Args:
@@ -672,7 +724,8 @@ def beam_embedding_attention_decoder(decoder_inputs,
         initial_state_attention=initial_state_attention,
         first_step=first_step,
         output_projection=output_projection,
-        beam_size=beam_size)
+        beam_size=beam_size,
+        eos_symbol=eos_symbol)
     else:
       return attention_decoder(
             emb_inp, initial_state, attention_states, cell, output_size=output_size, num_heads=num_heads, loop_function=loop_function, initial_state_attention=initial_state_attention, output_projection=output_projection)
@@ -691,7 +744,8 @@ def embedding_attention_seq2seq(encoder_inputs,
                                 initial_state_attention=False,
                                 first_step=False,
                                 beam_search=True,
-                                beam_size=10):
+                                beam_size=10,
+                                eos_symbol=None):
   """Embedding sequence-to-sequence model with attention.
   This model first embeds encoder_inputs by a newly created embedding (of shape
   [num_encoder_symbols x input_size]). Then it runs an RNN to encode
@@ -771,7 +825,8 @@ def embedding_attention_seq2seq(encoder_inputs,
           initial_state_attention=initial_state_attention,
           first_step=first_step,
           beam_search=beam_search,
-          beam_size=beam_size)
+          beam_size=beam_size,
+          eos_symbol=eos_symbol)
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
     def decoder(feed_previous_bool):
@@ -823,7 +878,8 @@ def attention_decoder_context(decoder_inputs,
                       first_step=False,
                       output_projection=None,
                       beam_search=True,
-                      beam_size=10):
+                      beam_size=10,
+                      eos_symbol=None):
   """RNN decoder with attention for the sequence-to-sequence model.
   In this context "attention" means that, during decoding, the RNN can look up
   information in the additional tensor attention_states, and it does this by
@@ -959,7 +1015,7 @@ def attention_decoder_context(decoder_inputs,
 
     log_beam_probs, beam_path, beam_symbols = [],[],[]
 
-    for i, (inp, context) in enumerate(zip(decoder_inputs, decoder_context)):
+    def decode_step(i, inp, context, prev, state, attns, log_beam_probs, beam_path, beam_symbols):
       if i > 0:
         variable_scope.get_variable_scope().reuse_variables()
       # If loop_function is set, we use it instead of decoder_inputs.
@@ -979,13 +1035,7 @@ def attention_decoder_context(decoder_inputs,
       #  x = linear([inp] + [context] + attns, input_size, True)
       
       if loop_function is not None and beam_search and i > 0:
-        context_size = int(context.get_shape().with_rank(2)[1])
-        context_list=[]
-        #print('context orig shape', context.shape, context[0].shape)
-        for kk in range(beam_size):
-          context_list.append(context)
-        context = tf.reshape(tf.concat(context_list, 1), [-1, context_size]) 
-        #print('context shape', context.shape)
+        context = tf.tile(context, [beam_size, 1])  # Same food context for all the beams
       #print('output size', output_size)
       x = linear([inp] + [context] + attns, input_size, True)
       
@@ -1004,18 +1054,30 @@ def attention_decoder_context(decoder_inputs,
       if loop_function is not None:
         prev = output
         if i == 0 and beam_search:
-          states = []
-          for kk in range(beam_size):
-            states.append(state)
-          state = tf.reshape(tf.concat(states, 0), [-1, state_size])
-          with variable_scope.variable_scope(variable_scope.get_variable_scope(), reuse=True):
-            attns = attention(state)
+          # The first step is shared by all the beams (the attention reads are the same for each copy of the state)
+          state = tf.tile(tf.reshape(state, [-1, state_size]), [beam_size, 1])
+          attns = [tf.tile(a, [beam_size, 1]) for a in attns]
 
       if loop_function is not None and beam_search:
-        outputs.append(tf.argmax(nn_ops.xw_plus_b(
-          output, output_projection[0], output_projection[1]), dimension=1))
+        output = tf.argmax(nn_ops.xw_plus_b(
+          output, output_projection[0], output_projection[1]), dimension=1)
+      return [output, prev, state] + attns
+
+    finished = None  # Whether each beam produced the EOS symbol (to skip the remaining steps)
+    for i, (inp, context) in enumerate(zip(decoder_inputs, decoder_context)):
+      if finished is not None:
+        step_outputs = _beam_search_step(
+          lambda probs, path, symbols: decode_step(i, inp, context, prev, state, attns, probs, path, symbols),
+          [outputs[-1], prev, state] + attns, finished, log_beam_probs, beam_path, beam_symbols)
       else:
-        outputs.append(output)
+        step_outputs = decode_step(i, inp, context, prev, state, attns, log_beam_probs, beam_path, beam_symbols)
+      output, prev, state = step_outputs[:3]
+      attns = step_outputs[3:]
+      outputs.append(output)
+
+      if eos_symbol is not None and beam_symbols:
+        beam_eos = math_ops.equal(beam_symbols[-1], eos_symbol)
+        finished = beam_eos if finished is None else math_ops.logical_or(finished, beam_eos)
 
     if loop_function is not None and beam_search:
       return outputs, state, tf.reshape(tf.concat(beam_path, 0),[-1,beam_size]), tf.reshape(tf.concat(beam_symbols, 0),[-1,beam_size]), tf.reshape(tf.concat(log_beam_probs, 0), [-1, beam_size])
@@ -1199,7 +1261,8 @@ def embedding_attention_decoder(decoder_inputs,
                                 initial_state_attention=False,
                                 first_step=False,
                                 beam_search=True,
-                                beam_size=10):
+                                beam_size=10,
+                                eos_symbol=None):
   """RNN decoder with embedding and attention and a pure-decoding option.
   Args:
     decoder_inputs: A list of 1D batch-sized int32 Tensors (decoder inputs).
@@ -1277,7 +1340,8 @@ def embedding_attention_decoder(decoder_inputs,
         first_step=first_step,
         output_projection=output_projection,
         beam_search=beam_search,
-        beam_size=beam_size)
+        beam_size=beam_size,
+        eos_symbol=eos_symbol)
 
 
 def embedding_attention_context_seq2seq(encoder_inputs,
@@ -1295,7 +1359,8 @@ def embedding_attention_context_seq2seq(encoder_inputs,
                                 initial_state_attention=False,
                                 first_step=False,
                                 beam_search=True,
-                                beam_size=10):
+                                beam_size=10,
+                                eos_symbol=None):
   """Embedding sequence-to-sequence model with attention.
   This model first embeds encoder_inputs by a newly created embedding (of shape
   [num_encoder_symbols x input_size]). Then it runs an RNN to encode
@@ -1376,7 +1441,8 @@ def embedding_attention_context_seq2seq(encoder_inputs,
           initial_state_attention=initial_state_attention,
           first_step=first_step,
           beam_search=beam_search,
-          beam_size=beam_size)
+          beam_size=beam_size,
+          eos_symbol=eos_symbol)
 
     # If feed_previous is a Tensor, we construct 2 graphs and use cond.
     def decoder(feed_previous_bool):
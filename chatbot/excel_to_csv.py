@@ -1,20 +1,31 @@
 # -*- coding: utf-8 -*-
-import xlrd
 import csv
 from os import sys
 
-def csv_from_excel(excel_file):
-    workbook = xlrd.open_workbook(excel_file)
-    all_worksheets = workbook.sheet_names()
-    for worksheet_name in all_worksheets:
-        worksheet = workbook.sheet_by_name(worksheet_name)
-        your_csv_file = open(''.join([worksheet_name,'.csv']), 'w', encoding='utf-8')
-        wr = csv.writer(your_csv_file, quoting=csv.QUOTE_ALL)
+OUTPUT_BUFFER_SIZE = 1 << 20  # 1MB, fewer write calls for the large sheets
+
+def sheets_from_excel(excel_file):
+    """Yield (worksheet_name, rows) for each worksheet, the rows being streamed"""
+    if excel_file.endswith('.xlsx'):  # Read-only mode streams the rows instead of loading the whole sheet
+        from openpyxl import load_workbook
+        workbook = load_workbook(excel_file, read_only=True, data_only=True)
+        try:  # The read-only workbook keeps the file open until closed
+            for worksheet in workbook.worksheets:
+                yield worksheet.title, worksheet.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    else:  # Old .xls format (not supported by openpyxl)
+        import xlrd
+        workbook = xlrd.open_workbook(excel_file, on_demand=True)
+        for worksheet_name in workbook.sheet_names():
+            worksheet = workbook.sheet_by_name(worksheet_name)
+            yield worksheet_name, (worksheet.row_values(rownum) for rownum in range(worksheet.nrows))
 
-        for rownum in range(worksheet.nrows):
-            print(worksheet.row_values(rownum))
-            wr.writerow(worksheet.row_values(rownum))
-        your_csv_file.close()
+def csv_from_excel(excel_file):
+    for worksheet_name, rows in sheets_from_excel(excel_file):
+        with open(''.join([worksheet_name,'.csv']), 'w', encoding='utf-8', newline='', buffering=OUTPUT_BUFFER_SIZE) as your_csv_file:
+            wr = csv.writer(your_csv_file, quoting=csv.QUOTE_ALL)
+            wr.writerows(rows)
 
 if __name__ == "__main__":
     csv_from_excel(sys.argv[1])
@@ -96,6 +96,12 @@ class Model:
         self.decoderWeights = None  # Adjust the learning to the target sentence size
         self.decoderContext = None
 
+        # Training input pipeline (the batches are pushed by a background thread, see enqueue())
+        self.QUEUE_CAPACITY = 4  # Number of batches prefetched
+        self.queueInputs = None  # Placeholders of the full (time major) batch tensors
+        self.enqueueOp = None
+        self.closeQueueOp = None
+
         # Main operators
         self.lossFct = None
         self.optOp = None
@@ -144,18 +150,21 @@ class Model:
         #encoDecoCell = tf.contrib.rnn.DropoutWrapper(encoDecoCell, input_keep_prob=1.0, output_keep_prob=1.0)  # TODO: Custom values (WARNING: No dropout when testing !!!)
         encoDecoCell = tf.contrib.rnn.MultiRNNCell([encoDecoCell] * self.args.numLayers, state_is_tuple=bool(not self.args.beam_search))
 
-        # Network input (placeholders)
+        # Network input (placeholders on testing mode, input queue on training mode)
 
-        with tf.name_scope('placeholder_encoder'):
-            self.encoderInputs  = [tf.placeholder(tf.int32,   [None, ]) for _ in range(self.args.maxLengthEnco)]  # Batch size * sequence length * input dim
+        if self.args.test:
+            with tf.name_scope('placeholder_encoder'):
+                self.encoderInputs  = [tf.placeholder(tf.int32,   [None, ]) for _ in range(self.args.maxLengthEnco)]  # Batch size * sequence length * input dim
 
-        with tf.name_scope('placeholder_decoder'):
-            self.decoderInputs  = [tf.placeholder(tf.int32,   [None, ], name='inputs') for _ in range(self.args.maxLengthDeco)]  # Same sentence length for input and output (Right ?)
-            self.decoderTargets = [tf.placeholder(tf.int32,   [None, ], name='targets') for _ in range(self.args.maxLengthDeco)]
-            self.decoderWeights = [tf.placeholder(tf.float32, [None, ], name='weights') for _ in range(self.args.maxLengthDeco)]
+            with tf.name_scope('placeholder_decoder'):
+                self.decoderInputs  = [tf.placeholder(tf.int32,   [None, ], name='inputs') for _ in range(self.args.maxLengthDeco)]  # Same sentence length for input and output (Right ?)
+                self.decoderTargets = [tf.placeholder(tf.int32,   [None, ], name='targets') for _ in range(self.args.maxLengthDeco)]
+                self.decoderWeights = [tf.placeholder(tf.float32, [None, ], name='weights') for _ in range(self.args.maxLengthDeco)]
 
-            if self.args.corpus == 'healthy-comments':
-                self.decoderContext = [tf.placeholder(tf.float32, [None, 64,], name='context') for _ in range(self.args.maxLengthDeco)]
+                if self.args.food_context:  # Only the context decoder consumes it
+                    self.decoderContext = [tf.placeholder(tf.float32, [None, 64,], name='context') for _ in range(self.args.maxLengthDeco)]
+        else:
+            self.buildInputQueue()
 
         # Define the network
         # Here we use an embedding model, it takes integer as input and convert them into word vector for
@@ -183,7 +192,8 @@ class Model:
                 feed_previous=bool(self.args.test),  # When we test (self.args.test), we use previous output as next input (feed_previous)
                 first_step=self.args.first_step,
                 beam_search=bool(self.args.beam_search),
-                beam_size=self.args.beam_size
+                beam_size=self.args.beam_size,
+                eos_symbol=self.textData.eosToken  # Used to stop the beam search once all the beams are done
             )
         else:
             decoderOutputs, states, beamPath, beamSymbols, beamProbs = rnn_model(
@@ -196,7 +206,8 @@ class Model:
                 output_projection=outputProjection.getWeights() if outputProjection else None,
                 feed_previous=bool(self.args.test),
                 beam_search=bool(self.args.beam_search),
-                beam_size=self.args.beam_size
+                beam_size=self.args.beam_size,
+                eos_symbol=self.textData.eosToken
             )
             print(len(decoderOutputs))
 
@@ -233,11 +244,61 @@ class Model:
             )
             self.optOp = opt.minimize(self.lossFct)
 
+    def buildInputQueue(self):
+        """ Create the training input pipeline
+        The batches are pushed into a queue by a background thread, so the training steps only read from the queue
+        (no feed_dict marshalling on the critical path and the batch preparation overlaps with the training)
+        """
+        with tf.name_scope('input_queue'):
+            self.queueInputs = [
+                tf.placeholder(tf.int32,   [self.args.maxLengthEnco, None], name='encoder_inputs'),  # Sequence length * batch size
+                tf.placeholder(tf.int32,   [self.args.maxLengthDeco, None], name='decoder_inputs'),
+                tf.placeholder(tf.int32,   [self.args.maxLengthDeco, None], name='decoder_targets'),
+                tf.placeholder(tf.float32, [self.args.maxLengthDeco, None], name='decoder_weights'),
+            ]
+            if self.args.food_context:
+                self.queueInputs.append(tf.placeholder(tf.float32, [self.args.maxLengthDeco, None, 64], name='decoder_context'))
+
+            queue = tf.FIFOQueue(self.QUEUE_CAPACITY, [placeholder.dtype for placeholder in self.queueInputs])
+            self.enqueueOp = queue.enqueue(self.queueInputs)
+            self.closeQueueOp = queue.close(cancel_pending_enqueues=True)
+
+            queueOutputs = queue.dequeue()
+            for output, placeholder in zip(queueOutputs, self.queueInputs):
+                output.set_shape(placeholder.get_shape())
+
+        # Split the sequences, the network works on a list of time steps
+        self.encoderInputs  = tf.unstack(queueOutputs[0])
+        self.decoderInputs  = tf.unstack(queueOutputs[1])
+        self.decoderTargets = tf.unstack(queueOutputs[2])
+        self.decoderWeights = tf.unstack(queueOutputs[3])
+        if self.args.food_context:
+            self.decoderContext = tf.unstack(queueOutputs[4])
+
+    def enqueue(self, batch):
+        """ Operation pushing a training batch into the input queue
+        Does not perform run on itself but just return the operator to do so
+        Args:
+            batch (Batch): Input and target of the next training step
+        Return:
+            op, dict: The enqueue operator with the associated feed dictionary
+        """
+        feedDict = {
+            self.queueInputs[0]: batch.encoderSeqs,
+            self.queueInputs[1]: batch.decoderSeqs,
+            self.queueInputs[2]: batch.targetSeqs,
+            self.queueInputs[3]: batch.weights,
+        }
+        if self.args.food_context:
+            feedDict[self.queueInputs[4]] = batch.contextSeqs
+
+        return self.enqueueOp, feedDict
+
     def step(self, batch, match_encoder_decoder_input=False):
         """ Forward/training step operation.
         Does not perform run on itself but just return the operators to do so. Those have then to be run
         Args:
-            batch (Batch): Input data on testing mode, input and target on output mode
+            batch (Batch): Input data on testing mode, ignored on training mode (the batches are pushed with enqueue())
         Return:
             (ops), dict: A tuple of the (training, loss) operators or (outputs,) in testing mode with the associated feed dictionary
         """
@@ -246,19 +307,10 @@ class Model:
         feedDict = {}
         ops = None
 
-        if not self.args.test:  # Training
-            if not self.args.finetune:
-                for i in range(self.args.maxLengthEnco):
-                    feedDict[self.encoderInputs[i]]  = batch.encoderSeqs[i]
-            for i in range(self.args.maxLengthDeco):
-                feedDict[self.decoderInputs[i]]  = batch.decoderSeqs[i]
-                feedDict[self.decoderTargets[i]] = batch.targetSeqs[i]
-                feedDict[self.decoderWeights[i]] = batch.weights[i]
-                if self.args.corpus == 'healthy-comments':
-                    feedDict[self.decoderContext[i]] = batch.contextSeqs[i]
-
+        if not self.args.test:  # Training (the inputs are read from the queue, see enqueue())
             ops = (self.optOp, self.lossFct)
-        else:  # Testing (batchSize == 1)
+        else:  # Testing (batchSize == 1 with beam search)
+            batchSize = len(batch.encoderSeqs[0])
             for i in range(self.args.maxLengthEnco):
                 feedDict[self.encoderInputs[i]]  = batch.encoderSeqs[i]
             if match_encoder_decoder_input:
@@ -266,9 +318,9 @@ class Model:
                 for i in range(self.args.maxLengthDeco):
                     feedDict[self.decoderInputs[i]]  = batch.decoderSeqs[i]
             else:
-                feedDict[self.decoderInputs[0]]  = [self.textData.goToken]
+                feedDict[self.decoderInputs[0]]  = [self.textData.goToken] * batchSize
                 #print('decoder input size', len(batch.decoderSeqs[i]), batch.decoderSeqs[i], self.textData.goToken)
-                if self.args.corpus == 'healthy-comments':
+                if self.args.food_context:
                     for i in range(self.args.maxLengthDeco):
                         #print('context size', len(batch.contextSeqs[i]), batch.contextSeqs[i])
                         #print(i, batch.contextSeqs[i])
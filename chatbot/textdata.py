@@ -19,13 +19,16 @@ Loads the dialogue corpus, builds the vocabulary
 
 import numpy as np
 import nltk  # For tokenize
+import concurrent.futures  # Parallel tokenization
+import functools
+import itertools
 from tqdm import tqdm  # Progress bar
 import pickle  # Saving the data
-import math  # For float comparison
+import gc
 import os  # Checking file existance
 import random
-import numpy as np
-import urllib
+import http.client  # Food IDs server
+import urllib.parse
 import json
 
 from chatbot.cornelldata import CornellData
@@ -33,6 +36,67 @@ from chatbot.mealdata import MealData
 from chatbot.healthydata import HealthyData
 
 
+_tokenizers = None  # Created once per process (nltk.sent_tokenize/word_tokenize look up the punkt model and build a new tokenizer at each call)
+
+
+def getTokenizers():
+    """Return the sentence and word tokenizers, loading them on the first call
+    Return:
+        tuple: the punkt sentence tokenizer and the treebank word tokenizer
+    """
+    global _tokenizers
+    if _tokenizers is None:
+        _tokenizers = (nltk.data.load('tokenizers/punkt/english.pickle'), nltk.tokenize.TreebankWordTokenizer())
+    return _tokenizers
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def tokenizeSentence(sentence):
+    """Split a sentence into lowercased tokens
+    Cached, the corpora contain a lot of repeated short sentences ("ok", "yes", food names,...)
+    Args:
+        sentence (str): a single sentence
+    Return:
+        tuple<str>: the tokens (a tuple, so the cached value can not be modified)
+    """
+    return tuple(getTokenizers()[1].tokenize(sentence.lower()))  # Ignore case (after the sentence split, which relies on it)
+
+
+def tokenizeText(line, isTarget, maxLength):
+    """Split a line into tokens, keeping as many sentences as the maximum length allows
+    Does not touch the vocabulary, so it can be run in a worker process (see TextData.createCorpus)
+    Args:
+        line (str): a line containing the text to extract
+        isTarget (bool): Define the question on the answer
+        maxLength (int): the maximum number of tokens to keep
+    Return:
+        list<tuple<str>>: the tokens of each kept sentence, in the order they have been selected
+    """
+    sentences = []
+    nbTokens = 0
+
+    # Extract sentences
+    sentencesToken = getTokenizers()[0].tokenize(line)
+
+    # We add sentence by sentence until we reach the maximum length
+    for i in range(len(sentencesToken)):
+        # If question: we only keep the last sentences
+        # If answer: we only keep the first sentences
+        if not isTarget:
+            i = len(sentencesToken)-1 - i
+
+        tokens = tokenizeSentence(sentencesToken[i])
+
+        # If the total length is not too big, we still can add one more sentence
+        if nbTokens + len(tokens) <= maxLength:
+            sentences.append(tokens)
+            nbTokens += len(tokens)
+        else:
+            break  # We reach the max length already
+
+    return sentences
+
+
 class Batch:
     """Struct containing batches info
     """
@@ -44,6 +108,63 @@ class Batch:
         self.weights = []
 
 
+def getIdType(vocabularySize):
+    """Return the smallest type able to store the word ids
+    Args:
+        vocabularySize (int): number of words of the vocabulary
+    Return:
+        np.dtype: uint16 for the usual corpora, int32 for the bigger ones
+    """
+    return np.uint16 if vocabularySize <= np.iinfo(np.uint16).max + 1 else np.int32
+
+
+class PackedSamples:
+    """Training samples stored as flat uint16/int32 arrays with their offsets (one array for all the inputs, one for
+    all the targets), instead of a list of python lists
+    Behave as a read-only list of [input, target(, context)] samples, the sequences being views on the arrays
+    """
+    def __init__(self, inputs, inputOffsets, targets, targetOffsets, contexts=None):
+        self.inputs = inputs  # All the input sequences, concatenated
+        self.inputOffsets = inputOffsets  # Start of each input sequence (and end of the last one)
+        self.targets = targets
+        self.targetOffsets = targetOffsets
+        self.contexts = contexts  # Food embedding of each sample (healthy-comments only)
+
+    @classmethod
+    def fromList(cls, samples, idType=np.int32):
+        """Pack a list of [input, target(, context)] samples
+        Args:
+            samples (list<Obj>): the samples to pack
+            idType (np.dtype): type of the stored word ids (see getIdType)
+        """
+        inputOffsets = np.zeros(len(samples) + 1, dtype=np.int64)
+        np.cumsum([len(sample[0]) for sample in samples], out=inputOffsets[1:])
+        targetOffsets = np.zeros(len(samples) + 1, dtype=np.int64)
+        np.cumsum([len(sample[1]) for sample in samples], out=targetOffsets[1:])
+        contexts = None
+        if samples and len(samples[0]) > 2:
+            contexts = np.array([sample[2] for sample in samples], dtype=np.float32)
+        return cls(
+            np.fromiter(itertools.chain.from_iterable(sample[0] for sample in samples), dtype=idType, count=inputOffsets[-1]),
+            inputOffsets,
+            np.fromiter(itertools.chain.from_iterable(sample[1] for sample in samples), dtype=idType, count=targetOffsets[-1]),
+            targetOffsets,
+            contexts
+        )
+
+    def __len__(self):
+        return len(self.inputOffsets) - 1
+
+    def __getitem__(self, i):
+        sample = [
+            self.inputs[self.inputOffsets[i]:self.inputOffsets[i+1]],
+            self.targets[self.targetOffsets[i]:self.targetOffsets[i+1]]
+        ]
+        if self.contexts is not None:
+            sample.append(self.contexts[i])
+        return sample
+
+
 class TextData:
     """Dataset class
     Warning: No vocabulary limit
@@ -106,12 +227,25 @@ class TextData:
         self.eosToken = -1  # End of sequence
         self.unknownToken = -1  # Word dropped from vocabulary
 
-        self.trainingSamples = []  # 2d array containing each question and his answer [[input,target]]
+        self.trainingSamples = []  # 2d array containing each question and his answer [[input,target]] (packed at the end of createCorpus)
+        self.sampleOrder = None  # Order of the samples for the current epoch
 
         self.word2id = {}
         self.id2word = {}  # For a rapid conversion
+        self.id2wordArray = None  # Same as id2word, but allow to convert a whole sequence at once
+        self.tokenizedTexts = {}  # Tokens of the corpus texts, computed in parallel by createCorpus
+
+        if self.args.food_context:  # USDA food embeddings stacked in a single matrix, to sum the foods of a test sentence
+            usdaFoods = sorted(self.args.usda_vecs)
+            self.usdaIds = {foodID: i for i, foodID in enumerate(usdaFoods)}
+            self.usdaMatrix = np.array([self.args.usda_vecs[foodID] for foodID in usdaFoods], dtype=np.float32)
+
+            self.FOOD_SERVER = '128.30.34.150:5000'  # Predict the foods of the test sentences
+            self.FOOD_QUERY = '/lana/api/v1.0/query_IDs?raw_text='
+            self.foodConnection = None  # Kept open between the sentences (keep-alive)
 
         self.loadCorpus(self.samplesDir)
+        self.id2wordArray = np.array([self.id2word[i] for i in range(len(self.id2word))], dtype=object)
 
         # Plot some stats:
         print('Loaded: {} words, {} QA'.format(len(self.word2id), len(self.trainingSamples)))
@@ -140,7 +274,7 @@ class TextData:
         """Shuffle the training samples
         """
         print("Shuffling the dataset...")
-        random.shuffle(self.trainingSamples)
+        self.sampleOrder = np.random.permutation(self.getSampleSize())  # The packed samples are not moved
 
     def _createBatch(self, samples):
         """Create a single batch from the list of sample. The batch size is automatically defined by the number of
@@ -155,71 +289,43 @@ class TextData:
 
         batch = Batch()
         batchSize = len(samples)
-
-        # Create the batch tensor
-        for i in range(batchSize):
+        maxLengthEnco = self.args.maxLengthEnco
+        maxLengthDeco = self.args.maxLengthDeco
+        goToken = self.goToken
+        eosToken = self.eosToken
+        invertSamples = not self.args.test and self.args.watsonMode
+        matchDecoderInput = self.args.match_encoder_decoder_input
+        foodContext = self.args.food_context
+        firstStep = self.args.first_step
+
+        # Create the batch tensor (padded arrays, directly time major as the model inputs)
+        batch.encoderSeqs = np.full((maxLengthEnco, batchSize), self.padToken, dtype=np.int32)
+        batch.decoderSeqs = np.full((maxLengthDeco, batchSize), self.padToken, dtype=np.int32)
+        batch.targetSeqs = np.full((maxLengthDeco, batchSize), self.padToken, dtype=np.int32)
+        batch.contextSeqs = np.zeros((maxLengthDeco, batchSize, 64), dtype=np.float32) if foodContext else None  # Only fed to the context decoder
+        targetLengths = np.zeros(batchSize, dtype=np.int32)
+        for i, sample in enumerate(samples):
             # Unpack the sample
-            sample = samples[i]
-            if not self.args.test and self.args.watsonMode:  # Watson mode: invert question and answer
+            if invertSamples:  # Watson mode: invert question and answer
                 sample = list(reversed(sample))
-            batch.encoderSeqs.append(list(reversed(sample[0])))  # Reverse inputs (and not outputs), little trick as defined on the original seq2seq paper
-            target_seq_with_go = [self.goToken] + sample[1] + [self.eosToken]
-            if self.args.match_encoder_decoder_input:
-                # use encoder input as decoder input
-                batch.decoderSeqs.append([self.goToken] + sample[0] + [self.eosToken])
-            else:
-                batch.decoderSeqs.append(target_seq_with_go)  # Add the <go> and <eos> tokens
-            if self.args.food_context:
-                if self.args.first_step:
-                    batch.contextSeqs.append([sample[2]]+[np.zeros(64,)]*(self.args.maxLengthDeco - 1)) # add food embedding context
+            inputSeq = sample[0]
+            targetSeq = sample[1]
+            decoderSeq = inputSeq if matchDecoderInput else targetSeq  # Optionally use encoder input as decoder input
+
+            batch.encoderSeqs[maxLengthEnco-len(inputSeq):, i] = inputSeq[::-1]  # Reverse inputs (and not outputs), little trick as defined on the original seq2seq paper (left padding)
+            batch.decoderSeqs[0, i] = goToken  # Add the <go> and <eos> tokens
+            batch.decoderSeqs[1:len(decoderSeq)+1, i] = decoderSeq
+            batch.decoderSeqs[len(decoderSeq)+1, i] = eosToken
+            batch.targetSeqs[:len(targetSeq), i] = targetSeq  # target seq, but shifted to the left (ignore the <go>)
+            batch.targetSeqs[len(targetSeq), i] = eosToken
+            targetLengths[i] = len(targetSeq) + 1
+            if foodContext:  # add food embedding context
+                if firstStep:
+                    batch.contextSeqs[0, i] = sample[2]
                 else:
-                    batch.contextSeqs.append([sample[2]]*self.args.maxLengthDeco) # add food embedding context
-            batch.targetSeqs.append(target_seq_with_go[1:])  # target seq, but shifted to the left (ignore the <go>)
-
-            # Long sentences should have been filtered during the dataset creation
-            assert len(batch.encoderSeqs[i]) <= self.args.maxLengthEnco
-            assert len(batch.decoderSeqs[i]) <= self.args.maxLengthDeco
-
-            # Add padding & define weight
-            batch.encoderSeqs[i]   = [self.padToken] * (self.args.maxLengthEnco  - len(batch.encoderSeqs[i])) + batch.encoderSeqs[i]  # Left padding for the input
-            batch.weights.append([1.0] * len(batch.targetSeqs[i]) + [0.0] * (self.args.maxLengthDeco - len(batch.targetSeqs[i])))
-            batch.decoderSeqs[i] = batch.decoderSeqs[i] + [self.padToken] * (self.args.maxLengthDeco - len(batch.decoderSeqs[i]))
-            batch.targetSeqs[i]  = batch.targetSeqs[i]  + [self.padToken] * (self.args.maxLengthDeco - len(batch.targetSeqs[i]))
-
-        # Simple hack to reshape the batch
-        encoderSeqsT = []  # Corrected orientation
-        for i in range(self.args.maxLengthEnco):
-            encoderSeqT = []
-            for j in range(batchSize):
-                encoderSeqT.append(batch.encoderSeqs[j][i])
-            encoderSeqsT.append(encoderSeqT)
-        batch.encoderSeqs = encoderSeqsT
-
-        decoderSeqsT = []
-        targetSeqsT = []
-        weightsT = []
-        contextSeqsT = []
-        for i in range(self.args.maxLengthDeco):
-            decoderSeqT = []
-            targetSeqT = []
-            weightT = []
-            contextSeqT = []
-            for j in range(batchSize):
-                decoderSeqT.append(batch.decoderSeqs[j][i])
-                targetSeqT.append(batch.targetSeqs[j][i])
-                weightT.append(batch.weights[j][i])
-                if self.args.food_context:
-                    contextSeqT.append(batch.contextSeqs[j][i])
-                else:
-                    contextSeqT.append(np.zeros(64,))
-            decoderSeqsT.append(decoderSeqT)
-            targetSeqsT.append(targetSeqT)
-            weightsT.append(weightT)
-            contextSeqsT.append(contextSeqT)
-        batch.decoderSeqs = decoderSeqsT
-        batch.targetSeqs = targetSeqsT
-        batch.weights = weightsT
-        batch.contextSeqs = contextSeqsT
+                    batch.contextSeqs[:, i] = sample[2]
+
+        batch.weights = (np.arange(maxLengthDeco)[:, None] < targetLengths).astype(np.float32)  # Define weight
 
         # # Debug
         # self.printBatch(batch)  # Input inverted, padding should be correct
@@ -230,23 +336,42 @@ class TextData:
 
     def getBatches(self):
         """Prepare the batches for the current epoch
+        The batches are only created when iterated over (ie. on the thread feeding the model), so the whole epoch
+        is never held in memory
         Return:
-            list<Batch>: Get a list of the batches for the next epoch
+            generator<Batch>: Get the batches for the next epoch (see getBatchCount for their number)
         """
+        self._checkSampleLengths()
         self.shuffle()
 
-        batches = []
-
-        def genNextSamples():
-            """ Generator over the mini-batch training samples
+        def genNextBatches():
+            """ Generator over the mini-batches
             """
             for i in range(0, self.getSampleSize(), self.args.batchSize):
-                yield self.trainingSamples[i:min(i + self.args.batchSize, self.getSampleSize())]
+                yield self._createBatch([self.trainingSamples[j] for j in self.sampleOrder[i:i + self.args.batchSize]])
+
+        return genNextBatches()
 
-        for samples in genNextSamples():
-            batch = self._createBatch(samples)
-            batches.append(batch)
-        return batches
+    def _checkSampleLengths(self):
+        """Check that all the training samples fit in the model (vectorized, instead of for each sample in
+        _createBatch)
+        """
+        inputLengths = np.diff(self.trainingSamples.inputOffsets)
+        targetLengths = np.diff(self.trainingSamples.targetOffsets)
+        if not self.args.test and self.args.watsonMode:  # Inverted by _createBatch
+            inputLengths, targetLengths = targetLengths, inputLengths
+        decoderLengths = inputLengths if self.args.match_encoder_decoder_input else targetLengths
+
+        # Long sentences should have been filtered during the dataset creation
+        assert np.all(inputLengths <= self.args.maxLengthEnco)
+        assert np.all(decoderLengths + 2 <= self.args.maxLengthDeco)
+
+    def getBatchCount(self):
+        """Return the number of batches of an epoch
+        Return:
+            int: Number of batches returned by getBatches
+        """
+        return (self.getSampleSize() + self.args.batchSize - 1) // self.args.batchSize
 
     def getSampleSize(self):
         """Return the size of the dataset
@@ -310,29 +435,67 @@ class TextData:
 
     def saveDataset(self, dirName):
         """Save samples to file
+        The packed sequences are saved as .npy arrays next to the pickle (which contains the vocabulary), so
+        loadDataset can memory-map them
         Args:
             dirName (str): The directory where to load/save the model
         """
-
-        with open(os.path.join(dirName, self.samplesName), 'wb') as handle:
+        arrays = {
+            "inputs": self.trainingSamples.inputs,
+            "inputOffsets": self.trainingSamples.inputOffsets,
+            "targets": self.trainingSamples.targets,
+            "targetOffsets": self.trainingSamples.targetOffsets,
+        }
+        if self.trainingSamples.contexts is not None:  # Food embedding of each sample (healthy-comments only)
+            arrays["contexts"] = self.trainingSamples.contexts
+        for name, array in arrays.items():
+            np.save(self._getArrayPath(dirName, name), array)
+
+        with open(os.path.join(dirName, self.samplesName), 'wb') as handle:  # Written last, its presence means the dataset is complete
             data = {  # Warning: If adding something here, also modifying loadDataset
-                "word2id": self.word2id,
-                "id2word": self.id2word,
-                "trainingSamples": self.trainingSamples,
+                "words": [self.id2word[i] for i in range(len(self.id2word))],  # The vocabulary, ordered by id
+                "arrays": sorted(arrays),
                 "responseWords": self.healthyData.getWords()
                 }
             pickle.dump(data, handle, -1)  # Using the highest protocol available
 
+    def _getArrayPath(self, dirName, name):
+        """Return the path of one of the sample arrays saved with the dataset
+        Args:
+            dirName (str): The directory where to load/save the model
+            name (str): the PackedSamples attribute
+        Return:
+            str: the .npy path
+        """
+        return os.path.join(dirName, '{}-{}.npy'.format(os.path.splitext(self.samplesName)[0], name))
+
     def loadDataset(self, dirName):
         """Load samples from file
         Args:
             dirName (str): The directory where to load the model
         """
-        with open(os.path.join(dirName, self.samplesName), 'rb') as handle:
-            data = pickle.load(handle)  # Warning: If adding something here, also modifying saveDataset
-            self.word2id = data["word2id"]
-            self.id2word = data["id2word"]
-            self.trainingSamples = data["trainingSamples"]
+        with open(os.path.join(dirName, self.samplesName), 'rb', buffering=1 << 20) as handle:  # Fewer read calls
+            gc.disable()  # Nothing to collect while unpickling, but the collector would scan all the new objects
+            try:
+                data = pickle.load(handle)  # Warning: If adding something here, also modifying saveDataset
+            finally:
+                gc.enable()
+            if "words" in data:
+                self.word2id = {word: wordId for wordId, word in enumerate(data["words"])}
+                self.id2word = dict(enumerate(data["words"]))
+                # Memory-mapped: the pages are only read when used, and shared between the processes loading the dataset
+                arrays = {name: np.load(self._getArrayPath(dirName, name), mmap_mode='r') for name in data["arrays"]}
+                self.trainingSamples = PackedSamples(
+                    arrays["inputs"],
+                    arrays["inputOffsets"],
+                    arrays["targets"],
+                    arrays["targetOffsets"],
+                    arrays.get("contexts")
+                )
+            else:  # Dataset saved by a previous version
+                self.word2id = data["word2id"]
+                self.id2word = data["id2word"]
+                self.trainingSamples = PackedSamples.fromList(data["trainingSamples"], getIdType(len(self.word2id)))
             self.responseWords = data["responseWords"]
 
             self.padToken = self.word2id["<pad>"]
@@ -351,7 +514,20 @@ class TextData:
 
         # Preprocessing data
 
-        
+        # Tokenize all the texts in parallel first (the vocabulary is then built sequentially, in the same
+        # order as before, so the word ids do not depend on the number of workers)
+        conversations = list(conversations)
+        texts = list({text for conversation in conversations for text in self._conversationTexts(conversation)})
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            tokenized = executor.map(
+                tokenizeText,
+                [text[0] for text in texts],
+                [text[1] for text in texts],
+                itertools.repeat(self.args.maxLength),
+                chunksize=256
+            )
+            self.tokenizedTexts = dict(zip(texts, tqdm(tokenized, desc="Tokenize texts", total=len(texts))))
+
         for conversation in tqdm(conversations, desc="Extract conversations"):
             if self.args.corpus == 'cornell':
                 self.extractConversation(conversation)
@@ -365,8 +541,56 @@ class TextData:
                 # encode and decode meals
                 self.extractMeal(conversation)
 
+        self.tokenizedTexts = {}
+        self.id2word = {wordId: word for word, wordId in self.word2id.items()}
+        self.trainingSamples = PackedSamples.fromList(self.trainingSamples, getIdType(len(self.word2id)))
+        if not self.args.finetune:  # Otherwise, the vocabulary is the one of the loaded dataset
+            self._sortVocabulary()
+
         # The dataset will be saved in the same order it has been extracted
 
+    def _sortVocabulary(self):
+        """Reassign the word ids by decreasing frequency on the training samples, so the most used embeddings are
+        close in memory. The special tokens keep the first ids
+        """
+        nbSpecialTokens = 4  # <pad>, <go>, <eos> and <unknown>, added first by createCorpus
+        samples = self.trainingSamples
+        counts = np.bincount(np.concatenate((samples.inputs, samples.targets)), minlength=len(self.word2id))
+        oldIds = np.concatenate((  # Old id of each new id
+            np.arange(nbSpecialTokens),
+            nbSpecialTokens + np.argsort(-counts[nbSpecialTokens:], kind='mergesort')  # Stable, ties keep the extraction order
+        ))
+        newIds = np.empty_like(oldIds)
+        newIds[oldIds] = np.arange(len(oldIds))
+
+        samples.inputs = newIds[samples.inputs].astype(samples.inputs.dtype)
+        samples.targets = newIds[samples.targets].astype(samples.targets.dtype)
+        self.id2word = {newId: self.id2word[oldId] for newId, oldId in enumerate(oldIds)}
+        self.word2id = {word: wordId for wordId, word in self.id2word.items()}
+
+    def _conversationTexts(self, conversation):
+        """Return the texts the extract functions will tokenize for the given conversation
+        Warning: Has to match the dispatch of createCorpus
+        Args:
+            conversation (Obj): a conversation as given to createCorpus
+        Return:
+            list<tuple<str,bool>>: the (text, isTarget) couples
+        """
+        if self.args.corpus == 'cornell':
+            lines = conversation["lines"]
+            return [(line["text"], False) for line in lines[:-1]] + [(line["text"], True) for line in lines[1:]]
+        elif self.args.encode_food_descrips or self.args.encode_food_ids:
+            foodTexts = []
+            if self.args.encode_food_descrips or self.args.encode_single_food_descrip:  # Same test as extractFoods
+                foodTexts = [(food_descrip, False) for food_descrip in conversation[0]]
+            return foodTexts + [(conversation[1], True)]
+        elif self.args.corpus == 'healthy-comments' and not self.args.finetune:
+            return [(conversation[0], False), (conversation[1], True)]
+        elif self.args.encode_single_food_descrip:
+            return [(conversation[0], False), (conversation[1], True)]
+        else:
+            return [(conversation, False), (conversation, True)]
+
     def extractConversation(self, conversation):
         """Extract the sample lines from the conversations
         Args:
@@ -418,7 +642,7 @@ class TextData:
                 inputWords.extend(self.extractText(food_descrip))
         elif self.args.encode_food_ids:
             for food_id in foods:
-                inputWords.append(self.getWordId(food_id))
+                inputWords.append(self.getWordId(food_id.lower()))
         targetWords = self.extractText(meal, True)
 
         if inputWords and targetWords:  # Filter wrong samples (if one of the list is empty)
@@ -434,33 +658,22 @@ class TextData:
         """
         words = []
 
-        # Extract sentences
-        sentencesToken = nltk.sent_tokenize(line)
-
-        # We add sentence by sentence until we reach the maximum length
-        for i in range(len(sentencesToken)):
-            # If question: we only keep the last sentences
-            # If answer: we only keep the first sentences
-            if not isTarget:
-                i = len(sentencesToken)-1 - i
-
-            tokens = nltk.word_tokenize(sentencesToken[i])
-
-            # If the total length is not too big, we still can add one more sentence
-            if len(words) + len(tokens) <= self.args.maxLength:
-                tempWords = []
-                for token in tokens:
-                    if self.args.finetune:
-                        tempWords.append(self.getWordId(token, create=False))
-                    else:
-                        tempWords.append(self.getWordId(token))  # Create the vocabulary and the training sentences
-
-                if isTarget:
-                    words = words + tempWords
+        sentences = self.tokenizedTexts.get((line, isTarget))
+        if sentences is None:  # Not pre-computed by createCorpus
+            sentences = tokenizeText(line, isTarget, self.args.maxLength)
+
+        for tokens in sentences:
+            tempWords = []
+            for token in tokens:
+                if self.args.finetune:
+                    tempWords.append(self.getWordId(token, create=False))
                 else:
-                    words = tempWords + words
+                    tempWords.append(self.getWordId(token))  # Create the vocabulary and the training sentences
+
+            if isTarget:
+                words = words + tempWords
             else:
-                break  # We reach the max length already
+                words = tempWords + words
 
         return words
 
@@ -468,28 +681,17 @@ class TextData:
         """Get the id of the word (and add it to the dictionary if not existing). If the word does not exist and
         create is set to False, the function will return the unknownToken value
         Args:
-            word (str): word to add
+            word (str): word to add (already lowercased)
             create (Bool): if True and the word does not exist already, the world will be added
         Return:
             int: the id of the word created
         """
         # Should we Keep only words with more than one occurrence ?
 
-        word = word.lower()  # Ignore case
-
-        # Get the id if the word already exist
-        wordId = self.word2id.get(word, -1)
-
-        # If not, we create a new entry
-        if wordId == -1:
-            if create:
-                wordId = len(self.word2id)
-                self.word2id[word] = wordId
-                self.id2word[wordId] = word
-            else:
-                wordId = self.unknownToken
-
-        return wordId
+        # Get the id if the word already exist, if not, we create a new entry (id2word is rebuilt at the end of createCorpus)
+        if create:
+            return self.word2id.setdefault(word, len(self.word2id))
+        return self.word2id.get(word, self.unknownToken)
 
     def printBatch(self, batch):
         """Print a complete batch, useful for debugging
@@ -506,28 +708,27 @@ class TextData:
     def sequence2str(self, sequence, clean=False, reverse=False):
         """Convert a list of integer into a human readable string
         Args:
-            sequence (list<int>): the sentence to print
+            sequence (list<int>): the sentence to print (can also be a np.array)
             clean (Bool): if set, remove the <go>, <pad> and <eos> tokens
             reverse (Bool): for the input, option to restore the standard order
         Return:
             str: the sentence
         """
 
-        if not sequence:
+        if sequence is None or len(sequence) == 0:
             return ''
 
+        sequence = np.asarray(sequence, dtype=np.int64)
         if not clean:
-            return ' '.join([self.id2word[idx] for idx in sequence])
+            return ' '.join(self.id2wordArray[sequence])
 
-        sentence = []
-        for wordId in sequence:
-            if wordId == self.eosToken:  # End of generated sentence
-                break
-            elif wordId != self.padToken and wordId != self.goToken:
-                sentence.append(self.id2word[wordId])
+        eosIndices = np.flatnonzero(sequence == self.eosToken)
+        if len(eosIndices):  # End of generated sentence
+            sequence = sequence[:eosIndices[0]]
+        sentence = self.id2wordArray[sequence[(sequence != self.padToken) & (sequence != self.goToken)]]
 
         if reverse:  # Reverse means input so no <eos> (otherwise pb with previous early stop)
-            sentence.reverse()
+            sentence = sentence[::-1]
 
         return ' '.join(sentence)
 
@@ -542,22 +743,51 @@ class TextData:
         Return:
             str: the sentence
         """
-        sequence = []
-        for i in range(len(batchSeq)):  # Sequence length
-            sequence.append(batchSeq[i][seqId])
-        return self.sequence2str(sequence, **kwargs)
+        return self.sequence2str([batchStep[seqId] for batchStep in batchSeq], **kwargs)
 
     def sentence2enco(self, sentence):
         """Encode a sequence and return a batch as an input for the model
         Return:
             Batch: a batch object containing the sentence, or none if something went wrong
         """
+        sample = self._sentence2sample(sentence)
+        if not sample:
+            return None
+
+        return self._createBatch([sample])  # Mono batch, no target output
+
+    def batchSentence2enco(self, sentences):
+        """Encode multiple sequences at once and return a single batch as an input for the model
+        Args:
+            sentences (list<str>): the raw input sentences
+        Return:
+            Batch: a batch object containing the valid sentences, or none if no sentence could be encoded
+            list<int>: the position (in sentences) of each sequence of the batch
+        """
+        samples = []
+        sentenceIds = []
+        for i, sentence in enumerate(sentences):
+            sample = self._sentence2sample(sentence)
+            if sample:
+                samples.append(sample)
+                sentenceIds.append(i)
+
+        if not samples:
+            return None, sentenceIds
+
+        return self._createBatch(samples), sentenceIds
+
+    def _sentence2sample(self, sentence):
+        """Convert a raw sentence into a sample (without target), ready to be given to _createBatch()
+        Return:
+            list: the sample, or none if something went wrong
+        """
 
         if sentence == '':
             return None
 
         # First step: Divide the sentence in token
-        tokens = nltk.word_tokenize(sentence)
+        tokens = [token for sentenceToken in getTokenizers()[0].tokenize(sentence) for token in tokenizeSentence(sentenceToken)]
         if len(tokens) > self.args.maxLength:
             return None
 
@@ -566,21 +796,44 @@ class TextData:
         for token in tokens:
             wordIds.append(self.getWordId(token, create=False))  # Create the vocabulary and the training sentences
 
-        # Third step: creating the batch (add padding, reverse)
-        sample = []
+        # Third step: creating the sample (the padding and reversing is done when creating the batch)
         # predict foods, then sum food embeddings
         if self.args.food_context:
             #output_map = self.args.model.run_model([sentence])
             #foodIDs = [food_seg['Hits'][0][1:] for food_seg in output_map.values()]
-            meal = sentence.replace(" ", "%20")
-            foodIDs = json.loads(urllib.request.urlopen("http://128.30.34.150:5000/lana/api/v1.0/query_IDs?raw_text="+meal).read().decode('utf-8'))
+            foodIDs = self._queryFoodIDs(sentence)
             print('foods', foodIDs)
-            embeddings = np.sum([self.args.usda_vecs[foodID] for foodID in foodIDs], axis=0)
-            batch = self._createBatch([[wordIds, [], embeddings]])
-        else:
-            batch = self._createBatch([[wordIds, []]])  # Mono batch, no target output
+            embeddings = self.usdaMatrix[[self.usdaIds[foodID] for foodID in foodIDs]].sum(axis=0)
+            return [wordIds, [], embeddings]
 
-        return batch
+        return [wordIds, []]
+
+    def _queryFoodIDs(self, sentence):
+        """Ask the food server for the USDA ids of the foods of the sentence
+        The HTTP connection is reused for the next sentences
+        Args:
+            sentence (str): the raw meal description
+        Return:
+            list<str>: the predicted food ids
+        """
+        url = self.FOOD_QUERY + urllib.parse.quote(sentence)
+        for retry in range(2):
+            if self.foodConnection is None:
+                self.foodConnection = http.client.HTTPConnection(self.FOOD_SERVER, timeout=10)
+            try:
+                self.foodConnection.request('GET', url)
+                response = self.foodConnection.getresponse()
+                body = response.read()  # Always read, so the connection can be reused
+                break
+            except (http.client.HTTPException, OSError):  # Connection closed by the server in-between, reconnect once
+                self.foodConnection.close()
+                self.foodConnection = None
+                if retry:
+                    raise
+
+        if response.status != 200:  # Not retried, the server did answer
+            raise RuntimeError('Food server error for \'{}\': HTTP {} {}'.format(sentence, response.status, response.reason))
+        return json.loads(body.decode('utf-8'))
 
     def deco2sentence(self, decoderOutputs):
         """Decode the output of the decoder and return a human friendly sentence
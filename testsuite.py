@@ -25,8 +25,17 @@ Warning: it does not check the performances of the program
 import unittest
 import io
 import sys
+import os
+import argparse
+import pickle
+import tempfile
+import shutil
+import types
+
+import numpy as np
 
 from chatbot import chatbot
+from chatbot.textdata import TextData, PackedSamples
 
 
 class TestChatbot(unittest.TestCase):
@@ -62,5 +71,155 @@ class TestChatbot(unittest.TestCase):
     def test_testing_daemon(self):
         pass
 
+
+class TestTextData(unittest.TestCase):
+    def setUp(self):
+        self.textData = TextData.__new__(TextData)  # No corpus loaded
+        self.textData.args = argparse.Namespace(
+            maxLengthEnco=3,
+            maxLengthDeco=4,
+            test=False,
+            watsonMode=False,
+            match_encoder_decoder_input=False,
+            food_context=False,
+            first_step=False
+        )
+        self.textData.padToken = 0
+        self.textData.goToken = 1
+        self.textData.eosToken = 2
+        self.textData.unknownToken = 3
+        self.dirName = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirName)
+
+    def test_create_batch(self):
+        batch = self.textData._createBatch([
+            [[4, 5], [6]],
+            [[7], [8, 9]],
+        ])
+
+        # Time major, inputs reversed and left padded
+        np.testing.assert_array_equal(batch.encoderSeqs, [[0, 0], [5, 0], [4, 7]])
+        np.testing.assert_array_equal(batch.decoderSeqs, [[1, 1], [6, 8], [2, 9], [0, 2]])
+        np.testing.assert_array_equal(batch.targetSeqs, [[6, 8], [2, 9], [0, 2], [0, 0]])
+        np.testing.assert_array_equal(batch.weights, [[1, 1], [1, 1], [0, 1], [0, 0]])
+        self.assertIsNone(batch.contextSeqs)
+
+    def _setVocabulary(self, words):
+        self.textData.word2id = {word: wordId for wordId, word in enumerate(words)}
+        self.textData.id2word = dict(enumerate(words))
+
+    def _assertSamplesEqual(self, packedSamples, samples):
+        self.assertEqual(len(packedSamples), len(samples))
+        for packedSample, sample in zip(packedSamples, samples):
+            self.assertEqual([list(seq) for seq in packedSample], sample)
+
+    def test_dataset_round_trip(self):
+        words = ['<pad>', '<go>', '<eos>', '<unknown>', 'hi', 'there', 'bye']
+        samples = [[[4, 5], [6]], [[6], [4, 5, 6]]]
+        self._setVocabulary(words)
+        self.textData.samplesName = 'dataset-unit-test.pkl'
+        self.textData.trainingSamples = PackedSamples.fromList(samples)
+        self.textData.healthyData = types.SimpleNamespace(getWords=lambda: ['<start>', 'hi'])
+        self.textData.saveDataset(self.dirName)
+
+        loaded = TextData.__new__(TextData)
+        loaded.samplesName = self.textData.samplesName
+        loaded.loadDataset(self.dirName)
+
+        self.assertEqual(loaded.word2id, self.textData.word2id)
+        self.assertEqual(loaded.id2word, self.textData.id2word)
+        self.assertEqual(loaded.responseWords, ['<start>', 'hi'])
+        self.assertEqual((loaded.padToken, loaded.goToken, loaded.eosToken, loaded.unknownToken), (0, 1, 2, 3))
+        self.assertIsInstance(loaded.trainingSamples.inputs, np.memmap)
+        self._assertSamplesEqual(loaded.trainingSamples, samples)
+
+    def test_dataset_legacy(self):
+        words = ['<pad>', '<go>', '<eos>', '<unknown>', 'hi', 'there']
+        samples = [[[4, 5], [5]], [[5], [4]]]
+        self._setVocabulary(words)
+        with open(os.path.join(self.dirName, 'dataset-legacy.pkl'), 'wb') as handle:  # Format of the previous versions
+            pickle.dump({
+                'word2id': self.textData.word2id,
+                'id2word': self.textData.id2word,
+                'trainingSamples': samples,
+                'responseWords': ['<start>', 'there']
+            }, handle, -1)
+
+        loaded = TextData.__new__(TextData)
+        loaded.samplesName = 'dataset-legacy.pkl'
+        loaded.loadDataset(self.dirName)
+
+        self.assertEqual(loaded.word2id, self.textData.word2id)
+        self.assertEqual(loaded.responseWords, ['<start>', 'there'])
+        self.assertEqual(loaded.unknownToken, 3)
+        self._assertSamplesEqual(loaded.trainingSamples, samples)
+
+
+class TestChatbotUtils(unittest.TestCase):
+    def setUp(self):
+        self.chatbot = chatbot.Chatbot()
+        self.rootDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootDir)
+
+    def test_bigram_log_prob(self):
+        words = ['<pad>', '<go>', '<eos>', 'a', 'b']
+        self.chatbot.textData = types.SimpleNamespace(
+            word2id={word: wordId for wordId, word in enumerate(words)},
+            responseWords=['<start>', 'a', 'b', '<start>', 'a', 'a', 'c'],  # 'c' is out of vocabulary
+            getVocabularySize=lambda: len(words)
+        )
+        self.chatbot._buildBigramTable()
+        startId = self.chatbot.bigramStartId
+
+        logProbs = self.chatbot._bigramLogProb(
+            np.array([startId, 3, 3, 4, 4]),
+            np.array([3, 4, 3, 3, 0])
+        )
+        # P(a|<start>)=2/2, P(b|a)=P(a|a)=1/3 (a is also followed by the unknown word), unseen bigrams are 0
+        np.testing.assert_allclose(logProbs, [0.0, np.log(1/3), np.log(1/3), 0.0, 0.0])
+
+    def test_load_legacy_model_params(self):
+        self.chatbot.args = argparse.Namespace(
+            rootDir=self.rootDir,
+            modelTag='unit-test',
+            reset=False,
+            createDataset=False,
+            maxLength=10,
+            watsonMode=False,
+        )
+        modelDir = os.path.join(self.rootDir, self.chatbot.MODEL_DIR_BASE + '-unit-test')
+        os.makedirs(modelDir)
+        with open(os.path.join(modelDir, self.chatbot.CONFIG_LEGACY_FILENAME), 'w') as configFile:  # Written by configparser
+            configFile.write('[General]\n')
+            configFile.write('version = {}\n'.format(self.chatbot.CONFIG_VERSION))
+            configFile.write('globstep = 1200\n')
+            configFile.write('maxlength = 5\n')
+            configFile.write('watsonmode = True\n')
+            configFile.write('\n')
+            configFile.write('[Network]\n')
+            configFile.write('hiddensize = 256\n')
+            configFile.write('numlayers = 2\n')
+            configFile.write('embeddingsize = 32\n')
+            configFile.write('softmaxsamples = 0\n')
+        with open(os.path.join(modelDir, self.chatbot.STEP_LOG_FILENAME), 'w') as stepLog:
+            stepLog.write('1500\n1800\n')
+
+        self.chatbot.loadModelParams()
+
+        self.assertEqual(self.chatbot.modelDir, modelDir)
+        self.assertEqual(self.chatbot.globStep, 1800)  # The step log is more recent than the config
+        self.assertEqual(self.chatbot.args.maxLength, 5)
+        self.assertTrue(self.chatbot.args.watsonMode)
+        self.assertEqual(self.chatbot.args.hiddenSize, 256)
+        self.assertEqual(self.chatbot.args.numLayers, 2)
+        self.assertEqual(self.chatbot.args.embeddingSize, 32)
+        self.assertEqual(self.chatbot.args.softmaxSamples, 0)
+        self.assertEqual((self.chatbot.args.maxLengthEnco, self.chatbot.args.maxLengthDeco), (5, 7))
+        self.assertEqual(self.chatbot.sentencesPrefix, self.chatbot.SENTENCES_PREFIX[::-1])
+
 if __name__ == '__main__':
     unittest.main()